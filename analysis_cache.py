@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+CACHE_DIR = os.environ.get('VIDEO_REMOVE_SILENCE_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'video-remove-silence'))
+MAX_SIZE = 1 << 30
+READ_SIZE = 1 << 20
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _read(filename):
+    try:
+        with open(filename, encoding='utf-8') as f:
+            value = f.read()
+    except FileNotFoundError:
+        return None
+    # The modification time is the last use for the LRU eviction.
+    os.utime(filename)
+    return value
+
+
+def _write(filename, value, cache_dir, max_size):
+    _write_file(filename, lambda f: f.write(value.encode('utf-8')), cache_dir, max_size)
+
+
+def _write_file(filename, write, cache_dir, max_size):
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(temp_name, filename)
+    except:
+        os.unlink(temp_name)
+        raise
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    # Removes least recently used entries until the cache fits into max_size bytes.
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total_size = sum( size for _, size, _ in entries )
+    for _, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.unlink(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def get_content_hash(path, cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    # Hashing a long recording is still slow, so the hash is memoized by path, size and mtime.
+    stat = os.stat(path)
+    hash_filename = os.path.join(cache_dir, _sha256('{}|{}|{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)) + '.hash')
+    content_hash = _read(hash_filename)
+    if content_hash:
+        return content_hash
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(block)
+    content_hash = sha256.hexdigest()
+    _write(hash_filename, content_hash, cache_dir, max_size)
+    return content_hash
+
+
+def get_key(path, threshold_level, threshold_duration, blend_duration, envelope=False, count_frames=False, cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    # The analysis keeps the probe, whose frame count depends on count_frames.
+    key = '{}|{!r}|{!r}|{!r}'.format(get_content_hash(path, cache_dir, max_size), float(threshold_level), float(threshold_duration), float(blend_duration))
+    if envelope:
+        key += '|envelope'
+    if count_frames:
+        key += '|count_frames'
+    return _sha256(key)
+
+
+def load(key, cache_dir=CACHE_DIR):
+    value = _read(os.path.join(cache_dir, key + '.json'))
+    return None if value is None else json.loads(value)
+
+
+def store(key, analysis, cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    _write(os.path.join(cache_dir, key + '.json'), json.dumps(analysis), cache_dir, max_size)
+
+
+def get_file(name, cache_dir=CACHE_DIR):
+    # Filename of a cached file, None when it is not cached.
+    filename = os.path.join(cache_dir, name)
+    try:
+        os.utime(filename)
+    except FileNotFoundError:
+        return None
+    return filename
+
+
+def store_file(name, write, cache_dir=CACHE_DIR, max_size=MAX_SIZE):
+    # write(f) writes the content to a binary file.
+    _write_file(os.path.join(cache_dir, name), write, cache_dir, max_size)
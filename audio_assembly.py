@@ -0,0 +1,196 @@
+import math
+import mmap
+import struct
+import wave
+
+import numpy as np
+
+import silence_detector
+
+
+WRITE_SIZE = 0x400000
+TRANSCRIPTION_FRAME_RATE = 16000
+RESAMPLE_ZEROS = 8
+RESAMPLE_BLOCK_FRAMES = 0x4000
+
+
+class MappedWave:
+    # Wave_read-like access to a memory mapped WAV file, reading frames is slicing the mapping.
+
+    def __init__(self, filename):
+        self._channels, self._sample_width, self._frame_rate, self._offset, length = silence_detector.get_data_chunk(filename)
+        self._frame_width = self._channels * self._sample_width
+        self._nframes = length // self._frame_width
+        self._pos = 0
+        with open(filename, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def getnchannels(self):
+        return self._channels
+
+    def getsampwidth(self):
+        return self._sample_width
+
+    def getframerate(self):
+        return self._frame_rate
+
+    def getnframes(self):
+        return self._nframes
+
+    def tell(self):
+        return self._pos
+
+    def rewind(self):
+        self._pos = 0
+
+    def setpos(self, pos):
+        if pos < 0 or pos > self._nframes:
+            raise ValueError('position not in range')
+        self._pos = pos
+
+    def readframes(self, nframes):
+        end = min(self._pos + nframes, self._nframes)
+        data = self._data[self._offset+self._pos*self._frame_width:self._offset+end*self._frame_width]
+        self._pos = end
+        return data
+
+    def close(self):
+        self._data.close()
+
+
+def encode_frames(values, sample_width):
+    if sample_width == 1:
+        return values.astype(np.int8).tobytes()
+    elif sample_width == 2:
+        return values.astype('<i2').tobytes()
+    elif sample_width == 3:
+        return values.astype('<i4').reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
+    elif sample_width == 4:
+        return values.astype('<i4').tobytes()
+    raise ValueError('unsupported sample width: {}'.format(sample_width))
+
+
+def crossfade(left_frames, right_frames, sample_width, channels):
+    # Linear ramp from left to right, truncated to integers like int() does.
+    left = silence_detector.decode_frames(left_frames, sample_width, channels).astype(np.float64)
+    right = silence_detector.decode_frames(right_frames, sample_width, channels).astype(np.float64)
+    length = len(left)
+    r = np.arange(length, dtype=np.float64) / (length - 1) if length > 1 else np.zeros(1)
+    l = 1 - r
+    return encode_frames(np.trunc(left * l[:, None] + right * r[:, None]), sample_width)
+
+
+def compress_audio(wav, start_frame, end_frame, result_frames):
+    if result_frames == 0:
+        return b''
+    elif result_frames == end_frame - start_frame:
+        wav.setpos(start_frame)
+        return wav.readframes(result_frames)
+    channels = wav.getnchannels()
+    sample_width = wav.getsampwidth()
+    frame_width = sample_width*channels
+    if result_frames*2 <= end_frame - start_frame:
+        left_length = result_frames
+        right_length = result_frames
+    else:
+        left_length = (end_frame - start_frame + 1) // 2
+        right_length = end_frame - start_frame - left_length
+    crossfade_length = right_length + left_length - result_frames
+    wav.setpos(start_frame)
+    left_frames = wav.readframes(left_length)
+    wav.setpos(end_frame - right_length)
+    right_frames = wav.readframes(right_length)
+    middle = crossfade(left_frames[(left_length-crossfade_length)*frame_width:], right_frames[:crossfade_length*frame_width], sample_width, channels)
+    if right_length == crossfade_length:
+        # The former per sample loop kept only the crossfade here, keep its output.
+        return middle
+    return b''.join((left_frames[:(left_length-crossfade_length)*frame_width], middle, right_frames[crossfade_length*frame_width:]))
+
+
+def iter_audio(wav, audio_regions, write_size=WRITE_SIZE):
+    # audio_regions are (start_frame, end_frame, result_frames), the output is yielded in large blocks.
+    chunks = []
+    chunks_size = 0
+    for start_frame, end_frame, result_frames in audio_regions:
+        chunk = compress_audio(wav, start_frame, end_frame, result_frames)
+        chunks.append(chunk)
+        chunks_size += len(chunk)
+        if chunks_size >= write_size:
+            yield b''.join(chunks)
+            chunks = []
+            chunks_size = 0
+    if chunks:
+        yield b''.join(chunks)
+
+
+def write_audio(wav, audio_regions, out_wav, write_size=WRITE_SIZE):
+    for block in iter_audio(wav, audio_regions, write_size):
+        out_wav.writeframes(block)
+
+
+def write_wav_header(f, channels, sample_width, frame_rate, nframes):
+    # Sizes that do not fit into 32 bits, above about 6 h of 48 kHz stereo, are written as RF64 with a ds64 chunk.
+    data_size = nframes * channels * sample_width
+    riff_size = 36 + data_size + (data_size & 1)
+    fmt = struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, channels, frame_rate, frame_rate * channels * sample_width, channels * sample_width, sample_width * 8)
+    if riff_size < 0xFFFFFFFF:
+        f.write(struct.pack('<4sI4s', b'RIFF', riff_size, b'WAVE') + fmt + struct.pack('<4sI', b'data', data_size))
+    else:
+        f.write(struct.pack('<4sI4s', b'RF64', 0xFFFFFFFF, b'WAVE'))
+        f.write(struct.pack('<4sIQQQI', b'ds64', 28, riff_size + 36, data_size, nframes, 0))
+        f.write(fmt + struct.pack('<4sI', b'data', 0xFFFFFFFF))
+
+
+def write_wav(wav, audio_regions, f):
+    # The header has the final length and the frames follow it, nothing seeks back, so f can be a pipe.
+    nframes = sum( result_frames for _, _, result_frames in audio_regions )
+    write_wav_header(f, wav.getnchannels(), wav.getsampwidth(), wav.getframerate(), nframes)
+    for block in iter_audio(wav, audio_regions):
+        f.write(block)
+    if nframes * wav.getnchannels() * wav.getsampwidth() & 1:
+        f.write(b'\0')
+
+
+def get_resample_weights(fractions, half_width, cutoff):
+    x = fractions[:, None] - np.arange(-half_width + 1, half_width + 1)
+    return 2 * cutoff * np.sinc(2 * cutoff * x) * (0.5 + 0.5 * np.cos(np.pi * x / half_width))
+
+
+def write_transcription_audio(wav, out, frame_rate=TRANSCRIPTION_FRAME_RATE, block_frames=RESAMPLE_BLOCK_FRAMES):
+    # Writes the audio as 16 bit mono at frame_rate to a filename or a binary file object, for speech recognition.
+    # Every output frame is interpolated with a Hann windowed sinc, which is also the low pass filter. Output frame
+    # k is at input frame k*p/q, its weights only depend on k*p%q, so they are computed once for common rates.
+    sample_width = wav.getsampwidth()
+    size = wav.getnframes()
+    gcd = math.gcd(wav.getframerate(), frame_rate)
+    p, q = wav.getframerate() // gcd, frame_rate // gcd
+    out_size = size * q // p
+    half_width = int(math.ceil(RESAMPLE_ZEROS * max(p / q, 1)))
+    cutoff = 0.5 * min(q / p, 1)
+    offsets = np.arange(-half_width + 1, half_width + 1)
+    table = get_resample_weights(np.arange(q) / q, half_width, cutoff) if q <= RESAMPLE_BLOCK_FRAMES else None
+    with wave.open(out, 'wb') as out_wav:
+        out_wav.setnchannels(1)
+        out_wav.setsampwidth(2)
+        out_wav.setframerate(frame_rate)
+        for start in range(0, out_size, block_frames):
+            positions = np.arange(start, min(start + block_frames, out_size), dtype=np.int64) * p
+            index = (positions // q)[:, None] + offsets
+            if table is None:
+                weights = get_resample_weights(positions % q / q, half_width, cutoff)
+            else:
+                weights = table[positions % q]
+            first = max(int(index[0, 0]), 0)
+            last = min(int(index[-1, -1]) + 1, size)
+            wav.setpos(first)
+            values = silence_detector.decode_frames(wav.readframes(last - first), sample_width, wav.getnchannels()).mean(axis=1)
+            valid = (index >= first) & (index < first + len(values))
+            samples = np.where(valid, values[np.clip(index - first, 0, len(values) - 1)], 0)
+            result = (samples * weights).sum(axis=1) * (32768 / (1 << (8 * sample_width - 1)))
+            out_wav.writeframes(np.clip(np.round(result), -32768, 32767).astype('<i2').tobytes())
@@ -0,0 +1,225 @@
+import bisect
+import subprocess
+import tempfile
+import wave
+
+import silence_detector
+
+
+READ_SIZE = 0x10000
+RING_FRAMES = 0x100000
+EDGE_MARGIN_FRAMES = 2
+
+
+class SpillStore:
+    # Wave_read-like access to the frame ranges of the stream that were kept for compress_audio.
+
+    def __init__(self, channels, sample_width, frame_rate):
+        self._channels = channels
+        self._sample_width = sample_width
+        self._frame_rate = frame_rate
+        self._frame_width = channels * sample_width
+        self._file = tempfile.TemporaryFile()
+        self._starts = []
+        self._segments = []
+        self._nframes = 0
+        self._pos = 0
+        self.stored_frames = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, start, data):
+        frames = len(data) // self._frame_width
+        if frames == 0:
+            return
+        end = start + frames
+        assert not self._segments or start >= self._segments[-1][1]
+        self._file.seek(0, 2)
+        if self._segments and self._segments[-1][1] == start:
+            segment_start, _, offset = self._segments[-1]
+            self._segments[-1] = (segment_start, end, offset)
+        else:
+            self._starts.append(start)
+            self._segments.append((start, end, self._file.tell()))
+        self._file.write(data)
+        self._nframes = max(self._nframes, end)
+        self.stored_frames += frames
+
+    def setnframes(self, nframes):
+        self._nframes = nframes
+
+    def getnchannels(self):
+        return self._channels
+
+    def getsampwidth(self):
+        return self._sample_width
+
+    def getframerate(self):
+        return self._frame_rate
+
+    def getnframes(self):
+        return self._nframes
+
+    def tell(self):
+        return self._pos
+
+    def rewind(self):
+        self._pos = 0
+
+    def setpos(self, pos):
+        if pos < 0 or pos > self._nframes:
+            raise wave.Error('position not in range')
+        self._pos = pos
+
+    def readframes(self, nframes):
+        nframes = min(nframes, self._nframes - self._pos)
+        if nframes <= 0:
+            return b''
+        index = bisect.bisect_right(self._starts, self._pos) - 1
+        if index < 0 or self._segments[index][1] < self._pos + nframes:
+            raise ValueError('frames {}-{} were not kept by the audio stream'.format(self._pos, self._pos + nframes))
+        start, _, offset = self._segments[index]
+        self._file.seek(offset + (self._pos - start) * self._frame_width)
+        data = self._file.read(nframes * self._frame_width)
+        self._pos += nframes
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class _Spiller:
+    # Moves decided frames from the ring buffer to the store and drops the middle of long silences.
+    # Frames of a silence that is still open go to a spool file once the ring buffer is full.
+
+    def __init__(self, store, detector, threshold_frames, keep_duration, ring_frames):
+        self.store = store
+        self.detector = detector
+        self.threshold_frames = threshold_frames
+        self.keep_duration = keep_duration
+        self.ring_frames = ring_frames
+        self.frame_width = detector.channels * detector.sample_width
+        self.ring = bytearray()
+        self.ring_start = 0
+        self.spool = None
+        self.spool_start = 0
+        self.processed = 0
+        self.next_run = 0
+
+    def feed(self, data):
+        self.detector.feed(data)
+        self.ring += data
+        self.update(False)
+
+    def finish(self):
+        self.detector.finish()
+        self.update(True)
+        self.store.setnframes(self.detector.size)
+        if self.spool is not None:
+            self.spool.close()
+
+    def update(self, final):
+        runs = self.detector.runs
+        settled = self.detector.done
+        while self.next_run < len(runs):
+            start, end = runs[self.next_run]
+            self.store_frames(start)
+            if end == settled and not final:
+                # The silence may go on with the next data.
+                if settled - self.ring_start > self.ring_frames:
+                    self.spool_frames(settled)
+                return
+            self.store_run(start, end)
+            self.next_run += 1
+        self.store_frames(settled)
+
+    def store_run(self, start, end):
+        h = self.detector.half_blend_frames
+        silence_start = start + (h if start > 0 else 0)
+        silence_end = end - (h if end < self.detector.size else 0)
+        length = silence_end - silence_start
+        if self.keep_duration is None or length <= 0 or length < self.threshold_frames:
+            self.store_frames(end)
+            return
+        frame_rate = self.detector.frame_rate
+        keep = int(self.keep_duration(length / frame_rate) * frame_rate) + EDGE_MARGIN_FRAMES
+        if silence_start + keep >= silence_end - keep:
+            self.store_frames(end)
+            return
+        self.store_frames(silence_start + keep)
+        self.release(silence_end - keep)
+        self.store_frames(end)
+
+    def store_frames(self, end):
+        for start in range(self.processed, end, self.ring_frames):
+            self.store.write(start, self.take(start, min(start + self.ring_frames, end)))
+        self.release(end)
+
+    def take(self, start, end):
+        frame_width = self.frame_width
+        data = b''
+        if start < self.ring_start:
+            spool_end = min(end, self.ring_start)
+            self.spool.seek((start - self.spool_start) * frame_width)
+            data = self.spool.read((spool_end - start) * frame_width)
+            start = spool_end
+        if start < end:
+            data += self.ring[(start-self.ring_start)*frame_width:(end-self.ring_start)*frame_width]
+        return data
+
+    def spool_frames(self, end):
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        self.spool.seek(0, 2)
+        self.spool.write(self.ring[:(end-self.ring_start)*self.frame_width])
+        del self.ring[:(end-self.ring_start)*self.frame_width]
+        self.ring_start = end
+
+    def release(self, end):
+        if end <= self.processed:
+            return
+        self.processed = end
+        if end >= self.ring_start:
+            del self.ring[:(end-self.ring_start)*self.frame_width]
+            self.ring_start = end
+            if self.spool is not None:
+                self.spool.seek(0)
+                self.spool.truncate()
+            self.spool_start = end
+
+
+def stream_silences(path, threshold_level, threshold_duration, keep_duration=None, blend_duration=silence_detector.BLEND_DURATION, ring_frames=RING_FRAMES, read_size=READ_SIZE):
+    # Finds silences while ffmpeg is still decoding the audio. Returns the silences in frames like
+    # detect_silences and a store with the audio, where keep_duration(duration) bounds the seconds
+    # compress_audio reads at each end of a silence, without it all audio is kept.
+    command = [ 'ffmpeg', '-i', path, '-vn', '-acodec', 'pcm_s16le', '-f', 'wav', '-' ]
+    decoder = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    store = None
+    try:
+        channels, sample_width, frame_rate, _ = silence_detector.read_wav_header(decoder.stdout)
+        detector = silence_detector.SilenceDetector(channels, sample_width, frame_rate, threshold_level, blend_duration)
+        threshold_frames = int(threshold_duration * frame_rate)
+        store = SpillStore(channels, sample_width, frame_rate)
+        spiller = _Spiller(store, detector, threshold_frames, keep_duration, ring_frames)
+        while True:
+            data = decoder.stdout.read(read_size)
+            if not data:
+                break
+            spiller.feed(data)
+        if decoder.wait() != 0:
+            raise subprocess.CalledProcessError(decoder.returncode, command)
+        spiller.finish()
+    except:
+        if store is not None:
+            store.close()
+        raise
+    finally:
+        if decoder.poll() is None:
+            decoder.kill()
+            decoder.wait()
+    silence_regions, including_end = silence_detector.to_silence_regions(detector.runs, detector.size, detector.half_blend_frames, threshold_frames, blend_duration)
+    return silence_regions, including_end, store
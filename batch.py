@@ -1,52 +1,215 @@
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
 import os
-from batch_silence_remover import remove_silences
-from extract_audio import extract_audio
-from batch_convert_audio import convert_audio
-from batch_transcribe import transcribation
-from summarization import summarize
+import shutil
+import analysis_cache
+from batch_silence_remover import Config, run
+from batch_transcribe import run_parallel
+from summarization import summarize_transcript
 import time
 import datetime
 
 
+RENDER_WORKERS = 2
+TRANSCRIBE_WORKERS = 2
+TRANSCRIBE_SESSIONS = 4
+SUMMARIZE_WORKERS = 2
+TRANSCRIBE_URI = 'ws://localhost:2800'
+MANIFEST = 'out/manifest.json'
+STABLE_SECONDS = 10
+POLL_INTERVAL = 2
+
+# Stages with the files they read and write for an input file name.
+STAGES = [
+    ('remove_silences', lambda filename: [ 'in/' + filename ], lambda filename: [ 'out/' + filename, 'out/' + filename + 'converted.wav' ]),
+    ('transcribation', lambda filename: [ 'out/' + filename + 'converted.wav' ], lambda filename: [ 'out/' + filename + '.txt' ]),
+    ('summarize', lambda filename: [ 'out/' + filename + '.txt' ], lambda filename: [ 'out/' + filename + '_summary.txt' ]),
+]
+
+
+def render(filename):
+    # Returns the gaps on the timeline of the result, transcription cuts its shards there.
+    result = run('in/' + filename, 'out/' + filename, Config(transcription_audio='out/' + filename + 'converted.wav'))
+    if not result.rendered:
+        # There are no gaps, the input is the result.
+        shutil.copyfile('in/' + filename, 'out/' + filename)
+    return result.output_silences
+
+
+def summarize_file(filename):
+    # Read text from file
+    txt_filename = 'out/' + filename + '.txt'
+    with open(txt_filename, 'r') as f:
+        text = f.read()
+    summary = summarize_transcript(text, 'Пожалуйста, подведите итоги встречи.')
+    # Save summary to file
+    summary_filename = 'out/' + filename + '_summary.txt'
+    with open(summary_filename, 'w') as f:
+        f.write(summary)
+
+
+async def run_stage(stage_times, stage, filename, semaphore, executor, function, *args):
+    # The semaphore bounds the stage concurrency, time waiting for it is not counted to the stage.
+    async with semaphore:
+        print('#', filename, stage)
+        time_start = time.time()
+        if executor is None:
+            result = await function(*args)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        stage_times[stage] += time.time() - time_start
+        return result
+
+
+def get_stat(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [ stat.st_size, stat.st_mtime_ns ]
+
+
+def get_signatures(entry, paths):
+    # The recording is identified by its content hash, so touching or copying it again does not redo anything.
+    # Outputs of a stage are inputs of the next one, the next stage reruns when they change.
+    return { path: entry['sha256'] if path == 'in/' + entry['filename'] else get_stat(path) for path in paths }
+
+
+def get_stage_record(entry, stage):
+    _, get_inputs, get_outputs = stage
+    return { 'inputs': get_signatures(entry, get_inputs(entry['filename'])), 'outputs': get_signatures(entry, get_outputs(entry['filename'])) }
+
+
+def is_current(entry, stage):
+    # Outputs only have to exist, an edited transcript is summarized again rather than overwritten.
+    _, get_inputs, get_outputs = stage
+    record = entry['stages'].get(stage[0])
+    if record is None or record['inputs'] != get_signatures(entry, get_inputs(entry['filename'])):
+        return False
+    return all( os.path.exists(path) for path in get_outputs(entry['filename']) )
+
+
+def load_manifest(filename=MANIFEST):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return { 'files': {} }
+
+
+def save_manifest(manifest, filename=MANIFEST):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+
+def list_inputs():
+    return [ filename for filename in sorted(os.listdir('in')) if not filename.endswith('.md') and not filename.startswith('.') ]
+
+
+async def process_file(entry, manifest, stage_times, semaphores, render_executor, executor):
+    filename = entry['filename']
+    for stage in STAGES:
+        if is_current(entry, stage):
+            print('#', filename, stage[0], 'is current')
+            continue
+        # Remove silences, it also writes the audio for transcription, then transcribe at the gaps it kept and summarize.
+        # Without the gaps of a former run, transcription finds them in its audio.
+        functions = {
+            'remove_silences': (semaphores['render'], render_executor, render, filename),
+            'transcribation': (semaphores['transcribe'], None, run_parallel, TRANSCRIBE_URI, 'out/' + filename + 'converted.wav', 'out/' + filename + '.txt', entry.get('silences'), TRANSCRIBE_SESSIONS),
+            'summarize': (semaphores['summarize'], executor, summarize_file, filename),
+        }
+        semaphore, stage_executor, function, *args = functions[stage[0]]
+        result = await run_stage(stage_times, stage[0], filename, semaphore, stage_executor, function, *args)
+        if stage[0] == 'remove_silences':
+            entry['silences'] = result
+        entry['stages'][stage[0]] = get_stage_record(entry, stage)
+        save_manifest(manifest)
+
+
+async def run_batch(stage_times, watch=False, stable_seconds=STABLE_SECONDS, poll_interval=POLL_INTERVAL):
+    # Schedules new or changed recordings once their size and mtime have not changed for stable_seconds, files that
+    # match the manifest only cost a stat of them and their outputs. Without watch, returns when nothing is left.
+    semaphores = {
+        'render': asyncio.Semaphore(RENDER_WORKERS),
+        'transcribe': asyncio.Semaphore(TRANSCRIBE_WORKERS),
+        'summarize': asyncio.Semaphore(SUMMARIZE_WORKERS),
+    }
+    manifest = load_manifest()
+    loop = asyncio.get_running_loop()
+    seen = {}
+    tasks = {}
+    failed = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=RENDER_WORKERS) as render_executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SUMMARIZE_WORKERS) as executor:
+            while True:
+                filenames = list_inputs()
+                for filename in set(seen) - set(filenames):
+                    del seen[filename]
+                for filename in filenames:
+                    if filename in tasks:
+                        continue
+                    path = 'in/' + filename
+                    stat = get_stat(path)
+                    entry = manifest['files'].get(filename)
+                    if stat is None:
+                        seen.pop(filename, None)
+                        continue
+                    if entry is None or [ entry['size'], entry['mtime_ns'] ] != stat:
+                        # New or changed, it may still be copied. A file not modified for stable_seconds starts at once.
+                        if seen.get(filename, (None,))[0] != stat:
+                            seen[filename] = stat, min(time.time(), stat[1] / 1e9)
+                        if time.time() - seen[filename][1] < stable_seconds:
+                            continue
+                        sha256 = await loop.run_in_executor(executor, analysis_cache.get_content_hash, path)
+                        if entry is None or entry['sha256'] != sha256:
+                            entry = { 'filename': filename, 'sha256': sha256, 'stages': {} }
+                            manifest['files'][filename] = entry
+                        entry['size'], entry['mtime_ns'] = stat
+                        save_manifest(manifest)
+                    seen.pop(filename, None)
+                    if all( is_current(entry, stage) for stage in STAGES ):
+                        continue
+                    if failed.get(filename) == entry['sha256']:
+                        # Retried on the next run or when the file is replaced, not again with the same content.
+                        continue
+                    failed.pop(filename, None)
+                    tasks[filename] = asyncio.ensure_future(process_file(entry, manifest, stage_times, semaphores, render_executor, executor))
+
+                for filename, task in list(tasks.items()):
+                    if not task.done():
+                        continue
+                    del tasks[filename]
+                    if task.exception() is not None:
+                        print('#', filename, 'failed:', repr(task.exception()))
+                        failed[filename] = manifest['files'][filename]['sha256']
+                if not watch and not tasks and not seen:
+                    return sorted(failed)
+                await asyncio.sleep(poll_interval)
+
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--watch', action='store_true', help='keep watching in/ for new or changed recordings')
+    parser.add_argument('--stable-seconds', type=float, default=STABLE_SECONDS, help='seconds the size of a new file must not change before it is processed')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='seconds between scans of in/')
+    args = parser.parse_args()
+
     time_start = time.time()
-    # Iterate files in path 'in'
-    for filename in os.listdir('in'):
-        if filename.endswith('.md'):
-            continue
-        
-        # Remove silences
-        print('#', filename, 'remove_silences')
-        remove_silences('in/' + filename, 'out/' + filename)
-        
-        # Extract audio
-        print('#', filename, 'extract_audio')
-        extract_audio('out/' + filename, 'out/' + filename + '.wav')
-        
-        # Convert audio
-        print('#', filename, 'convert_audio')
-        convert_audio('out/' + filename + '.wav', 'out/' + filename + 'converted.wav')
-        
-        # Transcribe
-        print('#', filename, 'transcribation')
-        transcribation('out/' + filename + 'converted.wav', 'out/' + filename + '.txt')
-        
-        # Summarize
-        print('#', filename, 'summarize')
-        # Read text from file
-        txt_filename = 'out/' + filename + '.txt'
-        with open(txt_filename, 'r') as f:
-            text = f.read()
-        text += '\n\nПожалуйста, подведите итоги встречи.'
-        summary = summarize(text)
-        # Save summary to file
-        summary_filename = 'out/' + filename + '_summary.txt'
-        with open(summary_filename, 'w') as f:
-            f.write(summary)
-    
+    stage_times = collections.defaultdict(float)
+    failed = asyncio.run(run_batch(stage_times, args.watch, args.stable_seconds, args.poll_interval))
+
     time_end = time.time()
     time_passed_formatted = str(datetime.timedelta(seconds=time_end - time_start))
     print('#', 'Done in', time_passed_formatted)
+    for stage, stage_time in stage_times.items():
+        print('#', stage, str(datetime.timedelta(seconds=stage_time)))
+    if failed:
+        print('#', 'Failed:', ', '.join(failed))
 
 
 if __name__ == "__main__":
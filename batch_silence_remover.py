@@ -1,117 +1,115 @@
 #!/usr/bin/env python3
 
-import argparse
-import collections
 import math
 import os
-import re
 import subprocess
 import sys
 import tempfile
+import types
 import wave
 
+import analysis_cache
+import audio_assembly
+import audio_stream
+import cut_plan
+import energy_envelope
 import ffprobe
-
-
-def find_silences(filename, args):
+import metrics
+import resumable_render
+import silence_detector
+import timecodes
+
+
+def save_silences(wav, silence_regions, filename):
+    with wave.open(filename, 'wb') as out_wav:
+        out_wav.setnchannels(wav.getnchannels())
+        out_wav.setsampwidth(wav.getsampwidth())
+        out_wav.setframerate(wav.getframerate())
+        for start, end in silence_regions:
+            wav.setpos(start)
+            frames = wav.readframes(end-start)
+            out_wav.writeframes(frames)
+
+
+def get_envelope(filename, envelope_name):
+    # The envelope is built once per video and kept in the analysis cache.
+    envelope_file = None if envelope_name is None else analysis_cache.get_file(envelope_name)
+    if envelope_file is not None:
+        return energy_envelope.load_envelope(envelope_file)
+    envelope = energy_envelope.build_envelope(filename)
+    if envelope_name is not None:
+        analysis_cache.store_file(envelope_name, lambda f: energy_envelope.save_envelope(envelope, f))
+    return envelope
+
+
+def find_silences(filename, args, envelope_name=None, executor=None):
     #global args
-    blend_duration = 0.005
-    with wave.open(filename) as wav:
-        size = wav.getnframes()
-        channels = wav.getnchannels()
-        sample_width = wav.getsampwidth()
+    if args.envelope:
+        envelope = get_envelope(filename, envelope_name)
+        silence_regions, including_end = energy_envelope.find_silences(envelope, args.threshold_level, args.threshold_duration)
+        if args.save_silence:
+            with audio_assembly.MappedWave(filename) as wav:
+                frame_rate = wav.getframerate()
+                save_silences(wav, [ (int(start*frame_rate), int(end*frame_rate)) for start, end in silence_regions ], args.save_silence)
+        return silence_regions, including_end
+
+    with audio_assembly.MappedWave(filename) as wav:
         frame_rate = wav.getframerate()
-        max_value = 1 << (8 * sample_width - 1)
-        half_blend_frames = int(blend_duration * frame_rate / 2)
-        blend_frames = half_blend_frames * 2
-        assert size > blend_frames > 0
-        square_threshold = max_value ** 2 * 10 ** (args.threshold_level / 10)
-        blend_squares = collections.deque()
-        blend = 0
-
-        def get_values():
-            frames_read = 0
-            while frames_read < size:
-                frames = wav.readframes(min(0x1000, size - frames_read))
-                frames_count = len(frames) // sample_width // channels
-                for frame_index in range(frames_count):
-                    yield frames[frame_index*channels*sample_width:(frame_index+1)*channels*sample_width]
-                frames_read += frames_count
-
-        def get_is_silence(blend):
-            results = 0
-            frames = get_values()
-            for index in range(half_blend_frames):
-                frame = next(frames)
-                square = 0
-                for channel in range(channels):
-                    value = int.from_bytes(frame[sample_width*channel:sample_width*channel+sample_width], 'little', signed=True)
-                    square += value*value
-                blend_squares.append(square)
-                blend += square
-            for index in range(size-half_blend_frames):
-                frame = next(frames)
-                square = 0
-                for channel in range(channels):
-                    value = int.from_bytes(frame[sample_width*channel:sample_width*channel+sample_width], 'little', signed=True)
-                    square += value*value
-                blend_squares.append(square)
-                blend += square
-                if index < half_blend_frames:
-                    yield blend < square_threshold * channels * (half_blend_frames + index + 1)
-                else:
-                    result = blend < square_threshold * channels * (blend_frames + 1)
-                    if result:
-                        results += 1
-                    yield result
-                    blend -= blend_squares.popleft()
-            for index in range(half_blend_frames):
-                blend -= blend_squares.popleft()
-                yield blend < square_threshold * channels * (blend_frames - index)
-
-        is_silence = get_is_silence(blend)
-
-        def to_regions(iterable):
-            iterator = enumerate(iterable)
-            while True:
-                try:
-                    index, value = next(iterator)
-                except StopIteration:
-                    return
-                if value:
-                    start = index
-                    while True:
-                        try:
-                            index, value = next(iterator)
-                            if not value:
-                                yield start, index
-                                break
-                        except StopIteration:
-                            yield start, index+1
-                            return
-
-        threshold_frames = int(args.threshold_duration * frame_rate)
-        silence_regions = ( (start, end) for start, end in to_regions(is_silence) if end-start >= blend_duration )
-        silence_regions = ( (start + (half_blend_frames if start > 0 else 0), end - (half_blend_frames if end < size else 0)) for start, end in silence_regions )
-        silence_regions = [ (start, end) for start, end in silence_regions if end-start >= threshold_frames ]
-        including_end = len(silence_regions) == 0 or silence_regions[-1][1] == size
-        silence_regions = [ (start/frame_rate, end/frame_rate) for start, end in silence_regions ]
+        if args.workers == 1:
+            silence_regions, including_end = silence_detector.detect_silences(wav, args.threshold_level, args.threshold_duration)
+        else:
+            silence_regions, including_end = silence_detector.detect_silences_parallel(filename, args.threshold_level, args.threshold_duration, workers=args.workers or None, executor=executor)
 
         if args.save_silence:
-            with wave.open(args.save_silence, 'wb') as out_wav:
-                out_wav.setnchannels(channels)
-                out_wav.setsampwidth(sample_width)
-                out_wav.setframerate(frame_rate)
-                for start, end in silence_regions:
-                    wav.setpos(start)
-                    frames = wav.readframes(end-start)
-                    out_wav.writeframes(frames)
+            save_silences(wav, silence_regions, args.save_silence)
 
+    silence_regions = [ (start/frame_rate, end/frame_rate) for start, end in silence_regions ]
     return silence_regions, including_end
 
 
+def stream_silences(path, args, video_frame_rate):
+    # Only the audio compress_audio reads around the ends of a silence is kept, which needs a monotonic transform_duration.
+    if args.save_silence or args.sublinear < 0 or args.linear < 0:
+        keep_duration = None
+    else:
+        keep_duration = lambda duration: transform_duration(duration + 2 / video_frame_rate, args) + 3 / video_frame_rate
+    silence_regions, including_end, wav = audio_stream.stream_silences(path, args.threshold_level, args.threshold_duration, keep_duration)
+    if args.save_silence:
+        save_silences(wav, silence_regions, args.save_silence)
+    frame_rate = wav.getframerate()
+    silence_regions = [ (start/frame_rate, end/frame_rate) for start, end in silence_regions ]
+    return silence_regions, including_end, wav
+
+
+def probe_video(path, args):
+    info = ffprobe.probe(path, args.count_frames, analysis_cache.CACHE_DIR if args.cache else None)
+    frames = info.frames
+    if frames:
+        frame_rate = frames / info.duration # N.B. Possibly we need to simply read frame rate instead of calculating it.
+    else:
+        frame_rate = info.frame_rate
+        frames = int(frame_rate * info.duration)
+    return { 'frames': frames, 'frame_rate': frame_rate, 'width': info.width, 'height': info.height }
+
+
+def get_analysis_key(path, args):
+    if not args.cache:
+        return None
+    return analysis_cache.get_key(path, args.threshold_level, args.threshold_duration, silence_detector.BLEND_DURATION, args.envelope, args.count_frames)
+
+
+def load_analysis(analysis_key, args):
+    # With --save-silence the audio of the gaps is needed, so the analysis is run again.
+    if analysis_key is None or args.save_silence:
+        return None
+    analysis = analysis_cache.load(analysis_key)
+    if analysis is not None:
+        analysis['silences'] = [ tuple(silence) for silence in analysis['silences'] ]
+    return analysis
+
+
 def extract_audio(input_filename, output_filename):
-    command = [ 'ffmpeg', '-i', input_filename, '-acodec', 'pcm_s16le', '-f', 'wav', '-y', output_filename ]
+    command = [ 'ffmpeg', '-i', input_filename, '-acodec', 'pcm_s16le', '-rf64', 'auto', '-f', 'wav', '-y', output_filename ]
     subprocess.run(command, stderr=subprocess.PIPE).check_returncode()
 
 
@@ -120,48 +118,162 @@ def transform_duration(duration, args):
     return args.constant + args.sublinear * math.log(duration + 1) + args.linear * duration
 
 
-def closest_frames(duration, frame_rate):
-    return int((duration + 1 / frame_rate / 2) // (1 / frame_rate))
-
-
 def format_offset(offset):
         return '{}:{}:{}'.format(int(offset) // 3600, int(offset) % 3600 // 60, offset % 60)
 
 
-def compress_audio(args, wav, start_frame, end_frame, result_frames):
-    if result_frames == 0:
-        return b''
-    elif result_frames == end_frame - start_frame:
-        wav.setpos(start_frame)
-        return wav.readframes(result_frames)
-    else:
-        channels = wav.getnchannels()
-        sample_width = wav.getsampwidth()
-        frame_width = sample_width*channels
-        if result_frames*2 <= end_frame - start_frame:
-            left_length = result_frames
-            right_length = result_frames
+DEFAULTS = {
+    'threshold_level': -40,
+    'threshold_duration': 0.2,
+    'constant': 0,
+    'sublinear': 0,
+    'linear': 0.1,
+    'save_silence': None,
+    'recalculate_time_in_description': None,
+    'rewrite_time_codes': [],
+    'workers': 1,
+    'stream_audio': False,
+    'render': 'filter',
+    'render_workers': 1,
+    'cache': True,
+    'envelope': False,
+    'count_frames': False,
+    'transcription_audio': None,
+    'metrics': None,
+    'profile': None,
+    'export_plan': [],
+    'analyze_only': False,
+    'resumable': False,
+}
+
+
+class Config(types.SimpleNamespace):
+    # Options of run, named like the attributes the command line parser sets.
+
+    def __init__(self, **options):
+        unknown = sorted(set(options) - set(DEFAULTS))
+        if unknown:
+            raise TypeError('unknown options: {}'.format(', '.join(unknown)))
+        options = dict(DEFAULTS, **options)
+        if options['resumable'] and options['render'] != 'filter':
+            # Segments are encoded with the filtergraph.
+            raise ValueError('resumable rendering does not support render={!r}'.format(options['render']))
+        options['rewrite_time_codes'] = list(options['rewrite_time_codes'] or [])
+        options['export_plan'] = list(options['export_plan'] or [])
+        super().__init__(**options)
+
+
+class Result:
+    # rendered is False when path_out was not written: with analyze_only or when there are no gaps.
+    # silences are in seconds of the input, output_silences the compressed ones in seconds of the result.
+    __slots__ = ('path', 'path_out', 'silences', 'output_silences', 'plan', 'rendered', 'metrics')
+
+    def __init__(self, path, path_out, silences, output_silences, plan, rendered, metrics):
+        self.path = path
+        self.path_out = path_out
+        self.silences = silences
+        self.output_silences = output_silences
+        self.plan = plan
+        self.rendered = rendered
+        self.metrics = metrics
+
+    def __repr__(self):
+        return 'Result({!r}, {} gaps, rendered={})'.format(self.path_out, len(self.silences), self.rendered)
+
+
+def run(path, path_out, config=None, metrics_callback=None, find_executor=None, render_executor=None):
+    # Never reads sys.argv or exits, so many jobs can run in one process. The executors replace the process
+    # pool of the gap search and the thread pool of chunk rendering, and are not shut down.
+    config = config or Config()
+    stage_metrics = metrics.Metrics(metrics_callback, config.profile)
+    stage_metrics.begin('probe')
+    analysis_key = get_analysis_key(path, config)
+    analysis = load_analysis(analysis_key, config)
+    probe = probe_video(path, config) if analysis is None else analysis['probe']
+    frames = probe['frames']
+    frame_rate = probe['frame_rate']
+    stage_metrics.set('media_duration', frames / frame_rate)
+    stage_metrics.set('frames', frames)
+
+    # The extracted audio is removed also when a stage fails.
+    audio_file = None
+    wav = None
+    try:
+        streamed = config.stream_audio and analysis is None and not config.envelope
+        if streamed:
+            print('Extracting audio and finding gaps...')
+            stage_metrics.begin('stream_audio')
+            silences, including_end, wav = stream_silences(path, config, frame_rate)
+            stage_metrics.add('decoder_bytes', wav.getnframes() * wav.getnchannels() * wav.getsampwidth())
         else:
-            left_length = (end_frame - start_frame + 1) // 2
-            right_length = end_frame - start_frame - left_length
-        crossfade_length = right_length + left_length - result_frames
-        crossfade_start = (result_frames - crossfade_length) // 2
-        wav.setpos(start_frame)
-        left_frames = wav.readframes(left_length)
-        wav.setpos(end_frame - right_length)
-        right_frames = wav.readframes(right_length)
-        result = bytearray(b'\x00'*result_frames*frame_width)
-        result[:(left_length-crossfade_length)*frame_width] = left_frames[:-crossfade_length*frame_width]
-        result[-(right_length-crossfade_length)*frame_width:] = right_frames[crossfade_length*frame_width:]
-        for i in range(crossfade_length):
-            r = i / (crossfade_length - 1)
-            l = 1 - r
-            for channel in range(channels):
-                signal_left = int.from_bytes(left_frames[(left_length-crossfade_length+i)*frame_width+channel*sample_width:(left_length-crossfade_length+i)*frame_width+(channel+1)*sample_width], 'little', signed=True)
-                signal_right = int.from_bytes(right_frames[i*frame_width+channel*sample_width:i*frame_width+(channel+1)*sample_width], 'little', signed=True)
-                result[(left_length-crossfade_length+i)*frame_width+channel*sample_width:(left_length-crossfade_length+i)*frame_width+(channel+1)*sample_width] = int(signal_left*l + signal_right*r).to_bytes(sample_width, 'little', signed=True)
-        return result
-    
+            audio_file = tempfile.NamedTemporaryFile(delete=False)
+            audio_file.close()
+
+            print('Extracting audio...')
+            stage_metrics.begin('extract_audio')
+            extract_audio(path, audio_file.name)
+            stage_metrics.add('decoder_bytes', os.path.getsize(audio_file.name))
+
+            if analysis is None:
+                print('Finding gaps...')
+                stage_metrics.begin('find_gaps')
+                envelope_name = analysis_cache.get_content_hash(path) + '.envelope.npz' if config.cache and config.envelope else None
+                silences, including_end = find_silences(audio_file.name, config, envelope_name, find_executor)
+            else:
+                print('Using cached gaps')
+                silences, including_end = analysis['silences'], analysis['including_end']
+
+        if analysis is None and analysis_key is not None:
+            analysis_cache.store(analysis_key, { 'probe': probe, 'silences': silences, 'including_end': including_end })
+
+        total_duration = sum(( end-start for start, end in silences ))
+
+        if len(silences) == 0:
+            print('Everything is fine')
+            if not streamed:
+                wav = audio_assembly.MappedWave(audio_file.name)
+            plan = cut_plan.make_plan(path, cut_plan.get_regions(silences, including_end), probe, wav.getnframes(), wav.getframerate(), lambda duration: transform_duration(duration, config))
+            for filename in config.export_plan:
+                cut_plan.export_plan(plan, filename)
+            if config.transcription_audio and not config.analyze_only:
+                # The result is the input, so is its audio.
+                audio_assembly.write_transcription_audio(wav, config.transcription_audio)
+            return Result(path, path_out, silences, [], plan, False, stage_metrics.finish(config.metrics))
+
+        print('Found {} gaps, {:.1f} seconds total'.format(len(silences), total_duration))
+        stage_metrics.begin('plan')
+        stage_metrics.set('gaps', len(silences))
+        regions = cut_plan.get_regions(silences, including_end)
+
+        time_map = timecodes.TimeMap(regions, frame_rate, frames, lambda duration: transform_duration(duration, config), cut_plan.closest_frames)
+        if config.recalculate_time_in_description:
+            with open(config.recalculate_time_in_description, encoding='utf-8') as description_file:
+                description = description_file.read()
+            with open('{}_result{}'.format(*os.path.splitext(config.recalculate_time_in_description)), 'w', encoding='utf-8') as description_file:
+                description_file.write(timecodes.rewrite_description(time_map, description))
+        for filename in config.rewrite_time_codes:
+            timecodes.rewrite_file(time_map, filename, '{}_result{}'.format(*os.path.splitext(filename)))
+
+        print('Processing {} frames...'.format(frames))
+        if not streamed:
+            wav = audio_assembly.MappedWave(audio_file.name)
+        plan = cut_plan.make_plan(path, regions, probe, wav.getnframes(), wav.getframerate(), lambda duration: transform_duration(duration, config))
+        for filename in config.export_plan:
+            cut_plan.export_plan(plan, filename)
+
+        if config.resumable and not config.analyze_only:
+            rendered, reused = resumable_render.render_resumable(plan, wav, path, path_out, workers=config.render_workers, transcription_audio=config.transcription_audio, stage_metrics=stage_metrics, executor=render_executor)
+            print('Rendered {} segments, reused {}'.format(rendered, reused))
+        elif not config.analyze_only:
+            cut_plan.render_plan(plan, wav, path, path_out, config.render, config.render_workers, config.transcription_audio, stage_metrics, render_executor)
+        output_silences = [ (time_map.map(start), time_map.map(end)) for start, end in silences ]
+        return Result(path, path_out, silences, output_silences, plan, not config.analyze_only, stage_metrics.finish(config.metrics))
+    finally:
+        if wav is not None:
+            wav.close()
+        if audio_file is not None:
+            os.unlink(audio_file.name)
+
 
 def remove_silences(
     path,
@@ -172,155 +284,84 @@ def remove_silences(
     sublinear=0,
     linear=0.1,
     save_silence=None,
-    recalculate_time_in_description=None
+    recalculate_time_in_description=None,
+    rewrite_time_codes=None,
+    workers=1,
+    stream_audio=False,
+    render='filter',
+    render_workers=1,
+    cache=True,
+    envelope=False,
+    count_frames=False,
+    transcription_audio=None,
+    metrics_report=None,
+    metrics_callback=None,
+    profile=None,
+    export_plan=None,
+    analyze_only=False,
+    resumable=False
     ):
+    # The former entry point, it exits when there are no gaps and returns the metrics report.
+    config = Config(
+        threshold_level=threshold_level,
+        threshold_duration=threshold_duration,
+        constant=constant,
+        sublinear=sublinear,
+        linear=linear,
+        save_silence=save_silence,
+        recalculate_time_in_description=recalculate_time_in_description,
+        rewrite_time_codes=rewrite_time_codes,
+        workers=workers,
+        stream_audio=stream_audio,
+        render=render,
+        render_workers=render_workers,
+        cache=cache,
+        envelope=envelope,
+        count_frames=count_frames,
+        transcription_audio=transcription_audio,
+        metrics=metrics_report,
+        profile=profile,
+        export_plan=export_plan,
+        analyze_only=analyze_only,
+        resumable=resumable
+        )
+    result = run(path, path_out, config, metrics_callback)
+    if not result.silences:
+        sys.exit(0)
+    return result.metrics
 
-    parser = argparse.ArgumentParser()
-    # parser.add_argument('path', type=str, help='path to video', default=path)
-    parser.add_argument('--threshold-level', type=float, default=-40, help='threshold level in dB')
-    parser.add_argument('--threshold-duration', type=float, default=0.2, help='threshold duration in seconds')
-    parser.add_argument('--constant', type=float, default=0, help='duration constant transform value')
-    parser.add_argument('--sublinear', type=float, default=0, help='duration sublinear transform factor')
-    parser.add_argument('--linear', type=float, default=0.1, help='duration linear transform factor')
-    parser.add_argument('--save-silence', type=str, help='filename for saving silence')
-    parser.add_argument('--recalculate-time-in-description', type=str, help='path to text file')
-    args = parser.parse_args()
 
+def render_from_plan(
+    plan_filename,
+    path_out,
+    path=None,
+    render='filter',
+    render_workers=1,
+    transcription_audio=None,
+    metrics_report=None,
+    metrics_callback=None,
+    profile=None
+    ):
+    # Renders a plan saved with --export-plan, the audio is extracted again but not analyzed.
+    with open(plan_filename, encoding='utf-8') as f:
+        plan = cut_plan.load_plan(f)
+    path = path or plan['path']
+    stage_metrics = metrics.Metrics(metrics_callback, profile)
+    stage_metrics.set('media_duration', plan['frames'] / plan['frame_rate'])
+    stage_metrics.set('frames', plan['frames'])
     audio_file = tempfile.NamedTemporaryFile(delete=False)
     audio_file.close()
-
-    print('Extracting audio...')
-    extract_audio(path, audio_file.name)
-
-    print('Finding gaps...')
-    silences, including_end = find_silences(audio_file.name, args)
-
-    total_duration = sum(( end-start for start, end in silences ))
-
-    if len(silences) == 0:
-        print('Everything is fine')
-        sys.exit(0)
-
-    print('Found {} gaps, {:.1f} seconds total'.format(len(silences), total_duration))
-    regions = []
-    if silences[0][0] > 0:
-        regions.append((0, silences[0][0], False))
-    for silence, next_silence in zip(silences[:-1], silences[1:]):
-        regions.append((silence[0], silence[1], True))
-        regions.append((silence[1], next_silence[0], False))
-    if including_end:
-        regions.append((silences[-1][0], None, True))
-    else:
-        regions.append((silences[-1][0], silences[-1][1], True))
-        regions.append((silences[-1][1], None, False))
-
-    frames = ffprobe.get_frames(path)
-    duration = ffprobe.get_duration(path)
-    if frames:
-        frame_rate = frames / duration # N.B. Possibly we need to simply read frame rate instead of calculating it.
-    else:
-        frame_rate = ffprobe.get_frame_rate(path)
-        frames = int(frame_rate * duration)
-
-    width, height = ffprobe.get_resolution(path)
-
-    if args.recalculate_time_in_description:
-        with open(args.recalculate_time_in_description, encoding='utf-8') as description_file:
-            description = description_file.read()
-        time_codes = {}
-        for time_code, h, m, s in re.findall('((\d+):(\d\d):(\d\d))', description):
-            time_codes[time_code] = int(h)*3600+int(m)*60+int(s)
-        current_position = 0
-        for start, end, is_silence in regions:
-            start_frame = int(start * frame_rate)
-            end_frame = frames if end is None else int(end * frame_rate)
-            duration = (end_frame - start_frame) / frame_rate
-            if is_silence:
-                new_duration = transform_duration(duration, args)
-            else:
-                new_duration = duration
-            for time_code, time_value in list(time_codes.items()):
-                if start <= time_value < end:
-                    time_codes[time_code] = int((time_value-start)/duration*new_duration+current_position)
-            current_position += new_duration
-        for time_code, time_value in sorted(time_codes.items(), key=lambda x: x[1], reverse=True):
-            description = description.replace(time_code, '{:d}:{:02d}:{:02d}'.format(time_value // 3600, (time_value // 60) % 60, time_value % 60))
-        description_base_name, description_extension = os.path.splitext(args.recalculate_time_in_description)
-        with open('{}_result{}'.format(*os.path.splitext(args.recalculate_time_in_description)), 'w', encoding='utf-8') as description_file:
-            description_file.write(description)
-
-    print('Processing {} frames...'.format(frames))
-    command = [ 'ffmpeg', '-i', path, '-f', 'image2pipe', '-pix_fmt', 'rgb24', '-vcodec', 'rawvideo', '-' ]
-    decoder = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-
-    video_track = tempfile.NamedTemporaryFile(delete=False)
-    video_track.close()
-    command = [ 'ffmpeg', '-framerate', str(frame_rate), '-s', '{}x{}'.format(width, height), '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-i', '-' ]
-    command += [ '-f', 'mp4', '-pix_fmt', 'yuv420p', '-y', video_track.name ]
-    encoder = subprocess.Popen(command, stdin=subprocess.PIPE)
-
-    audio_track = tempfile.NamedTemporaryFile(delete=False)
-    audio_track.close()
-    wav = wave.open(audio_file.name)
-    out_wav = wave.open(audio_track.name, 'wb')
-    size = wav.getnframes()
-    channels = wav.getnchannels()
-    sample_width = wav.getsampwidth()
-    audio_frame_rate = wav.getframerate()
-    out_wav.setnchannels(channels)
-    out_wav.setsampwidth(sample_width)
-    out_wav.setframerate(audio_frame_rate)
-
-    audio_remainder_frames = 0.0
-    for start, end, is_silence in regions:
-        start_frame = int(start * frame_rate)
-        end_frame = frames if end is None else int(end * frame_rate)
-        audio_start_frame = min(int(start * audio_frame_rate), size)
-        audio_end_frame = size if end is None else min(int(end * audio_frame_rate), size)
-        if is_silence:
-            duration = (end_frame - start_frame) / frame_rate
-            new_duration = transform_duration(duration, args)
-            new_frames_count = closest_frames(new_duration, frame_rate)
-            new_frames = set()
-            for index in range(new_frames_count):
-                new_frame = start_frame + int((index + 0.5)*(end_frame-start_frame)/new_frames_count)
-                assert not new_frame in new_frames
-                assert new_frame >= start_frame
-                assert new_frame < end_frame
-                new_frames.add(new_frame)
-            audio_delta_frames = audio_remainder_frames + (duration - new_frames_count / frame_rate) * audio_frame_rate
-            audio_remainder_frames = audio_delta_frames - int(audio_delta_frames)
-            if int(audio_delta_frames) > audio_end_frame - audio_start_frame:
-                audio_remainder_frames += audio_delta_frames - (audio_end_frame - audio_start_frame)
-                audio_delta_frames = audio_end_frame - audio_start_frame
-            audio_result_frames = audio_end_frame - audio_start_frame - int(audio_delta_frames)
-        else:
-            new_frames = set(range(start_frame, end_frame))
-            audio_result_frames = audio_end_frame-audio_start_frame
-        for index in range(start_frame, end_frame):
-            frame = decoder.stdout.read(width*height*3)
-            if index in new_frames:
-                encoder.stdin.write(frame)
-        out_wav.writeframes(compress_audio(args, wav, audio_start_frame, audio_end_frame, audio_result_frames))
-
-    wav.close()
-    os.unlink(audio_file.name)
-    out_wav.close()
-
-    encoder.stdin.close()
-
-    encoder.wait()
-    assert encoder.returncode == 0
-
-    decoder.terminate()
-
-    name, extension = os.path.splitext(path)
-    command = [ 'ffmpeg', '-f', 'mp4', '-i', video_track.name, '-f', 'wav', '-i', audio_track.name ]
-    command += [ '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', path_out ]
-    subprocess.run(command)
-
-    os.unlink(audio_track.name)
-    os.unlink(video_track.name)
+    try:
+        print('Extracting audio...')
+        stage_metrics.begin('extract_audio')
+        extract_audio(path, audio_file.name)
+        stage_metrics.add('decoder_bytes', os.path.getsize(audio_file.name))
+        print('Processing {} frames...'.format(plan['frames']))
+        with audio_assembly.MappedWave(audio_file.name) as wav:
+            cut_plan.render_plan(plan, wav, path, path_out, render, render_workers, transcription_audio, stage_metrics)
+    finally:
+        os.unlink(audio_file.name)
+    return stage_metrics.finish(metrics_report)
 
 
 def main():
@@ -4,6 +4,13 @@ import wave
 import json
 import sys
 
+import silence_detector
+
+
+SESSIONS = 4
+MIN_SHARD_DURATION = 30
+CHUNK_DURATION = 0.2
+
 
 def accept_feature_extractor(phrases, accept):    
     if len(accept)>1 and accept['text'] != '':        
@@ -49,6 +56,92 @@ async def run_test(uri, filename, out_filepath):
                 f.write("%s\n" % phrase)
 
 
+def get_shards(silences, duration, min_shard_duration=MIN_SHARD_DURATION):
+    # Shards are cut in the middle of silences, so no utterance is split, and are at least min_shard_duration long.
+    shards = []
+    start = 0
+    for silence_start, silence_end in silences:
+        middle = (silence_start + silence_end) / 2
+        if middle - start >= min_shard_duration and duration - middle >= min_shard_duration:
+            shards.append((start, middle))
+            start = middle
+    shards.append((start, duration))
+    return shards
+
+
+def get_phrase(accept, offset):
+    if len(accept) > 1 and accept.get('text', '') != '':
+        if 'result' in accept:
+            return offset + accept['result'][0]['start'], offset + accept['result'][-1]['end'], accept['text']
+        return offset, offset, accept['text']
+
+
+async def transcribe_shard(uri, filename, start, end):
+    # Audio is sent without waiting for the results, which are received concurrently.
+    phrases = []
+    with wave.open(filename, 'rb') as wf:
+        frame_rate = wf.getframerate()
+        start_frame = int(start * frame_rate)
+        end_frame = min(int(end * frame_rate), wf.getnframes())
+        buffer_size = int(frame_rate * CHUNK_DURATION)
+        offset = start_frame / frame_rate
+        async with websockets.connect(uri) as websocket:
+            messages = asyncio.get_running_loop().create_future()
+
+            async def send():
+                await websocket.send('{ "config" : { "sample_rate" : %d } }' % frame_rate)
+                count = 0
+                for position in range(start_frame, end_frame, buffer_size):
+                    wf.setpos(position)
+                    await websocket.send(wf.readframes(min(buffer_size, end_frame - position)))
+                    count += 1
+                # Every chunk and the end of file get an answer.
+                messages.set_result(count + 1)
+                await websocket.send('{"eof" : 1}')
+
+            async def receive():
+                received = 0
+                while not messages.done() or received < messages.result():
+                    phrase = get_phrase(json.loads(await websocket.recv()), offset)
+                    received += 1
+                    if phrase is not None:
+                        phrases.append(phrase)
+
+            await asyncio.gather(send(), receive())
+    return phrases
+
+
+def find_silences(filename):
+    with wave.open(filename, 'rb') as wf:
+        silences, _ = silence_detector.detect_silences(wf, -40, 0.2)
+        return [ (start / wf.getframerate(), end / wf.getframerate()) for start, end in silences ]
+
+
+async def run_parallel(uri, filename, out_filepath, silences=None, sessions=SESSIONS, min_shard_duration=MIN_SHARD_DURATION):
+    # Shards of the audio between silences, in seconds, are transcribed on a pool of concurrent sessions.
+    # Without silences they are found in the audio. Returns (start, end, text) phrases in timeline order.
+    with wave.open(filename, 'rb') as wf:
+        duration = wf.getnframes() / wf.getframerate()
+    if silences is None:
+        silences = await asyncio.get_running_loop().run_in_executor(None, find_silences, filename)
+    queue = asyncio.Queue()
+    for shard in get_shards(silences, duration, min_shard_duration):
+        queue.put_nowait(shard)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            start, end = queue.get_nowait()
+            results.extend(await transcribe_shard(uri, filename, start, end))
+
+    await asyncio.gather(*( worker() for _ in range(min(sessions, queue.qsize())) ))
+    phrases = sorted(results)
+    with open(out_filepath, 'w') as f:
+        for _, _, text in phrases:
+            f.write("%s\n" % text)
+    return phrases
+
+
 def transcribation(filename, out_filepath):
     asyncio.run(run_test('ws://localhost:2800', filename, out_filepath))
 
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+import audio_assembly
+import silence_detector
+import video_render
+from batch_silence_remover import extract_audio
+
+
+WAV_FORMATS = [ (1, 2), (2, 2), (2, 3), (1, 4) ]
+RESOLUTIONS = [ (320, 240), (1280, 720) ]
+FRAME_RATE = 44100
+VIDEO_FRAME_RATE = 25
+SPEECH_DURATION = 2.0
+SILENCE_DURATION = 1.0
+TOLERANCE = 0.8
+
+
+def get_layout(duration):
+    # Silences of SILENCE_DURATION after every SPEECH_DURATION, in seconds.
+    period = SPEECH_DURATION + SILENCE_DURATION
+    return [ (start + SPEECH_DURATION, min(start + period, duration)) for start in np.arange(0, duration - SPEECH_DURATION, period) ]
+
+
+def make_wav(filename, channels, sample_width, duration, frame_rate=FRAME_RATE):
+    # Noise at -10 dB with the silences of get_layout at -70 dB, the same for every run.
+    rng = np.random.default_rng(0)
+    size = int(duration * frame_rate)
+    max_value = 1 << (8 * sample_width - 1)
+    values = rng.normal(0, max_value * 0.3, (size, channels))
+    for start, end in get_layout(duration):
+        values[int(start*frame_rate):int(end*frame_rate)] *= 0.001
+    values = np.clip(np.round(values), -max_value, max_value - 1)
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(sample_width)
+        wav.setframerate(frame_rate)
+        wav.writeframes(audio_assembly.encode_frames(values, sample_width))
+
+
+def make_video(filename, width, height, duration, frame_rate=VIDEO_FRAME_RATE):
+    # The tone of the test source is muted during the silences of get_layout.
+    period = SPEECH_DURATION + SILENCE_DURATION
+    command = [ 'ffmpeg', '-f', 'lavfi', '-i', 'testsrc2=size={}x{}:rate={}:duration={}'.format(width, height, frame_rate, duration) ]
+    command += [ '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration) ]
+    command += [ '-af', "volume='if(lt(mod(t,{}),{}),1,0)':eval=frame".format(period, SPEECH_DURATION) ]
+    command += [ '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest', '-y', filename ]
+    subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).check_returncode()
+
+
+def measure(function, repeat):
+    # The best of repeat runs, the first one also warms up caches.
+    best = None
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - time_start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+
+def get_audio_regions(silences, size):
+    # Silences are compressed to a tenth like with the default transform.
+    regions = []
+    position = 0
+    for start, end in silences:
+        regions.append((position, start, start - position))
+        regions.append((start, end, (end - start) // 10))
+        position = end
+    regions.append((position, size, size - position))
+    return regions
+
+
+def get_kept_frames(duration, frame_rate=VIDEO_FRAME_RATE):
+    ranges = []
+    position = 0
+    for start, end in get_layout(duration):
+        video_render.append_frames(ranges, int(position * frame_rate), int(start * frame_rate))
+        for frame in range(int(start * frame_rate), int(end * frame_rate), 10):
+            video_render.append_frames(ranges, frame, frame + 1)
+        position = end
+    video_render.append_frames(ranges, int(position * frame_rate), int(duration * frame_rate))
+    return ranges
+
+
+def bench_audio(directory, duration, repeat, results):
+    for channels, sample_width in WAV_FORMATS:
+        name = '{}ch_{}bit'.format(channels, sample_width * 8)
+        filename = os.path.join(directory, name + '.wav')
+        make_wav(filename, channels, sample_width, duration)
+        samples = int(duration * FRAME_RATE) * channels
+
+        def detect():
+            with wave.open(filename) as wav:
+                return silence_detector.detect_silences(wav, -40, 0.2)[0]
+        seconds, silences = measure(detect, repeat)
+        assert len(silences) == len(get_layout(duration)), 'found {} silences'.format(len(silences))
+        results['detect_{}'.format(name)] = { 'seconds': seconds, 'samples_per_second': samples / seconds }
+
+        seconds, _ = measure(lambda: silence_detector.detect_silences_parallel(filename, -40, 0.2), repeat)
+        results['detect_parallel_{}'.format(name)] = { 'seconds': seconds, 'samples_per_second': samples / seconds }
+
+        def assemble():
+            with audio_assembly.MappedWave(filename) as wav, wave.open(os.path.join(directory, 'assembled.wav'), 'wb') as out_wav:
+                out_wav.setnchannels(channels)
+                out_wav.setsampwidth(sample_width)
+                out_wav.setframerate(FRAME_RATE)
+                audio_assembly.write_audio(wav, get_audio_regions(silences, wav.getnframes()), out_wav)
+        seconds, _ = measure(assemble, repeat)
+        results['assemble_{}'.format(name)] = { 'seconds': seconds, 'samples_per_second': samples / seconds }
+
+
+def bench_video(directory, duration, repeat, results):
+    frames = int(duration * VIDEO_FRAME_RATE)
+    ranges = get_kept_frames(duration)
+    for width, height in RESOLUTIONS:
+        name = '{}x{}'.format(width, height)
+        path = os.path.join(directory, name + '.mp4')
+        make_video(path, width, height, duration)
+        audio_path = os.path.join(directory, name + '.wav')
+        video_path = os.path.join(directory, name + '_video.mp4')
+
+        seconds, _ = measure(lambda: extract_audio(path, audio_path), repeat)
+        results['extract_{}'.format(name)] = { 'seconds': seconds, 'samples_per_second': duration * FRAME_RATE * 2 / seconds }
+
+        seconds, _ = measure(lambda: video_render.render_filtergraph(path, ranges, VIDEO_FRAME_RATE, audio_path, os.path.join(directory, name + '_filter.mp4')), repeat)
+        results['render_filter_{}'.format(name)] = { 'seconds': seconds, 'frames_per_second': frames / seconds }
+
+        seconds, _ = measure(lambda: video_render.render_pipe(path, ranges, frames, VIDEO_FRAME_RATE, width, height, 'yuv420p', video_path), repeat)
+        results['render_pipe_{}'.format(name)] = { 'seconds': seconds, 'frames_per_second': frames / seconds }
+
+        # Compare with render_pipe and mux together.
+        seconds, _ = measure(lambda: video_render.render_pipe(path, ranges, frames, VIDEO_FRAME_RATE, width, height, 'yuv420p', os.path.join(directory, name + '_muxed.mp4'), audio_path), repeat)
+        results['render_pipe_muxed_{}'.format(name)] = { 'seconds': seconds, 'frames_per_second': frames / seconds }
+
+        command = [ 'ffmpeg', '-f', 'mp4', '-i', video_path, '-f', 'wav', '-i', audio_path ]
+        command += [ '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', os.path.join(directory, name + '_mux.mp4') ]
+        seconds, _ = measure(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).check_returncode(), repeat)
+        results['mux_{}'.format(name)] = { 'seconds': seconds, 'frames_per_second': frames / seconds }
+
+
+def compare(results, baseline, tolerance):
+    # Returns the benchmarks whose rate fell below tolerance times the baseline rate.
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for unit in ('samples_per_second', 'frames_per_second'):
+            if unit in result and unit in baseline[name]:
+                ratio = result[unit] / baseline[name][unit]
+                print('{:<32} {:>14.1f} {:>7.2f}x'.format(name, result[unit], ratio))
+                if ratio < tolerance:
+                    regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type=float, default=60, help='duration of the synthetic media in seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every stage, the fastest one counts')
+    parser.add_argument('--output', type=str, help='filename for the JSON results, stdout by default')
+    parser.add_argument('--baseline', type=str, help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='fail when a rate is below this part of the baseline')
+    parser.add_argument('--no-video', action='store_true', help='skip the stages that need ffmpeg')
+    args = parser.parse_args()
+
+    results = {}
+    directory = tempfile.mkdtemp()
+    try:
+        bench_audio(directory, args.duration, args.repeat, results)
+        if args.no_video or shutil.which('ffmpeg') is None:
+            print('Skipping video stages', file=sys.stderr)
+        else:
+            bench_video(directory, args.duration, args.repeat, results)
+    finally:
+        shutil.rmtree(directory)
+
+    report = json.dumps({ 'duration': args.duration, 'results': results }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        if regressions:
+            print('Slower than the baseline: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+import json
+import os
+import tempfile
+
+import audio_assembly
+import ffprobe
+import metrics
+import video_render
+
+
+PLAN_VERSION = 1
+EDL_REEL = 'AX'
+
+
+def closest_frames(duration, frame_rate):
+    return int((duration + 1 / frame_rate / 2) // (1 / frame_rate))
+
+
+def get_regions(silences, including_end):
+    # Alternating speech and silence regions in seconds, the end of the last one is None.
+    if not silences:
+        return [ (0, None, False) ]
+    regions = []
+    if silences[0][0] > 0:
+        regions.append((0, silences[0][0], False))
+    for silence, next_silence in zip(silences[:-1], silences[1:]):
+        regions.append((silence[0], silence[1], True))
+        regions.append((silence[1], next_silence[0], False))
+    if including_end:
+        regions.append((silences[-1][0], None, True))
+    else:
+        regions.append((silences[-1][0], silences[-1][1], True))
+        regions.append((silences[-1][1], None, False))
+    return regions
+
+
+def make_plan(path, regions, probe, audio_frames, audio_frame_rate, transform_duration):
+    # Frame selection and audio compression of every region, everything rendering needs besides the media.
+    frames = probe['frames']
+    frame_rate = probe['frame_rate']
+    plan_regions = []
+    audio_regions = []
+    kept_frames = []
+    cut_frames = []
+    audio_remainder_frames = 0.0
+    for start, end, is_silence in regions:
+        start_frame = int(start * frame_rate)
+        end_frame = frames if end is None else int(end * frame_rate)
+        audio_start_frame = min(int(start * audio_frame_rate), audio_frames)
+        audio_end_frame = audio_frames if end is None else min(int(end * audio_frame_rate), audio_frames)
+        region = { 'start': start, 'end': end, 'silence': is_silence, 'frames': [ start_frame, end_frame ] }
+        if is_silence:
+            cut_frames.append(start_frame)
+            duration = (end_frame - start_frame) / frame_rate
+            new_duration = transform_duration(duration)
+            new_frames_count = closest_frames(new_duration, frame_rate)
+            new_frames = set()
+            for index in range(new_frames_count):
+                new_frame = start_frame + int((index + 0.5)*(end_frame-start_frame)/new_frames_count)
+                assert not new_frame in new_frames
+                assert new_frame >= start_frame
+                assert new_frame < end_frame
+                new_frames.add(new_frame)
+            audio_delta_frames = audio_remainder_frames + (duration - new_frames_count / frame_rate) * audio_frame_rate
+            audio_remainder_frames = audio_delta_frames - int(audio_delta_frames)
+            if int(audio_delta_frames) > audio_end_frame - audio_start_frame:
+                audio_remainder_frames += audio_delta_frames - (audio_end_frame - audio_start_frame)
+                audio_delta_frames = audio_end_frame - audio_start_frame
+            audio_result_frames = audio_end_frame - audio_start_frame - int(audio_delta_frames)
+            for index in sorted(new_frames):
+                video_render.append_frames(kept_frames, index, index + 1)
+            region.update({ 'duration': duration, 'new_duration': new_duration, 'new_frames': new_frames_count })
+        else:
+            video_render.append_frames(kept_frames, start_frame, end_frame)
+            audio_result_frames = audio_end_frame-audio_start_frame
+        region.update({ 'audio': [ audio_start_frame, audio_end_frame, audio_result_frames ], 'audio_remainder': audio_remainder_frames })
+        plan_regions.append(region)
+        audio_regions.append((audio_start_frame, audio_end_frame, audio_result_frames))
+
+    return {
+        'version': PLAN_VERSION,
+        'path': os.path.abspath(path),
+        'frames': frames,
+        'frame_rate': frame_rate,
+        'width': probe['width'],
+        'height': probe['height'],
+        'audio_frames': audio_frames,
+        'audio_frame_rate': audio_frame_rate,
+        'regions': plan_regions,
+        'kept_frames': kept_frames,
+        'cut_frames': cut_frames,
+        'audio_regions': audio_regions,
+    }
+
+
+def save_plan(plan, f):
+    json.dump(plan, f, indent=1)
+
+
+def load_plan(f):
+    plan = json.load(f)
+    if plan.get('version') != PLAN_VERSION:
+        raise ValueError('unsupported plan version {!r}'.format(plan.get('version')))
+    plan['kept_frames'] = [ tuple(frames) for frames in plan['kept_frames'] ]
+    plan['audio_regions'] = [ tuple(region) for region in plan['audio_regions'] ]
+    return plan
+
+
+def format_edl_time(frame, frame_rate):
+    # Non-drop frame timecode at the nominal rate, 29.97 is counted as 30.
+    rate = max(int(round(frame_rate)), 1)
+    seconds = frame // rate
+    return '{:02d}:{:02d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60, frame % rate)
+
+
+def write_edl(plan, f, title=None):
+    # CMX3600 with one cut per kept range. Audio follows the picture, the crossfades of compressed silences
+    # are not expressible in an EDL.
+    clip_name = os.path.basename(plan['path'])
+    frame_rate = plan['frame_rate']
+    f.write('TITLE: {}\n'.format(title or os.path.splitext(clip_name)[0]))
+    f.write('FCM: NON-DROP FRAME\n\n')
+    record_frame = 0
+    for event, (start, end) in enumerate(plan['kept_frames'], 1):
+        record_end = record_frame + end - start
+        f.write('{:03d}  {:<8} {:<5} {:<8} {} {} {} {}\n'.format(event, EDL_REEL, 'B', 'C',
+            format_edl_time(start, frame_rate), format_edl_time(end, frame_rate),
+            format_edl_time(record_frame, frame_rate), format_edl_time(record_end, frame_rate)))
+        f.write('* FROM CLIP NAME: {}\n\n'.format(clip_name))
+        record_frame = record_end
+
+
+def write_ffconcat(plan, f):
+    # The concat demuxer script of the kept ranges of the source.
+    path = plan['path'].replace("'", "'\\''")
+    frame_rate = plan['frame_rate']
+    f.write('ffconcat version 1.0\n')
+    for start, end in plan['kept_frames']:
+        f.write("file '{}'\ninpoint {:.6f}\noutpoint {:.6f}\n".format(path, start / frame_rate, end / frame_rate))
+
+
+def export_plan(plan, filename):
+    # Picks the format by the extension, JSON by default.
+    extension = filename.lower().rsplit('.', 1)[-1]
+    with open(filename, 'w', encoding='utf-8') as f:
+        if extension == 'edl':
+            write_edl(plan, f)
+        elif extension in ('ffconcat', 'concat'):
+            write_ffconcat(plan, f)
+        else:
+            save_plan(plan, f)
+
+
+def render_plan(plan, wav, path, path_out, render='filter', render_workers=1, transcription_audio=None, stage_metrics=None, executor=None):
+    # Assembles the audio of the plan from wav and renders the kept frames of path.
+    if wav.getnframes() != plan['audio_frames'] or wav.getframerate() != plan['audio_frame_rate']:
+        raise ValueError('the audio of {} does not match the plan: {} frames at {} Hz, expected {} at {} Hz'.format(
+            path, wav.getnframes(), wav.getframerate(), plan['audio_frames'], plan['audio_frame_rate']))
+    frames = plan['frames']
+    frame_rate = plan['frame_rate']
+    kept_frames = plan['kept_frames']
+    if stage_metrics is None:
+        stage_metrics = metrics.Metrics()
+    stage_metrics.set('frames_kept', sum( end - start for start, end in kept_frames ))
+    audio_bytes = sum( result_frames for _, _, result_frames in plan['audio_regions'] ) * wav.getnchannels() * wav.getsampwidth()
+    audio_track = None
+    try:
+        if not transcription_audio:
+            # The encoder that writes the final container reads the audio assembled on the fly from a pipe, there
+            # is no audio track on disk.
+            audio = lambda f: audio_assembly.write_wav(wav, plan['audio_regions'], f)
+        else:
+            stage_metrics.begin('assemble_audio')
+            audio_track = tempfile.NamedTemporaryFile(delete=False)
+            with audio_track:
+                audio_assembly.write_wav(wav, plan['audio_regions'], audio_track)
+            audio = audio_track.name
+        stage_metrics.add('encoder_bytes', audio_bytes)
+
+        if transcription_audio:
+            stage_metrics.begin('transcription_audio')
+            with audio_assembly.MappedWave(audio_track.name) as track:
+                audio_assembly.write_transcription_audio(track, transcription_audio)
+
+        stage_metrics.begin('render')
+        smart_cut_options = video_render.get_smart_cut_options(ffprobe.probe(path)) if render == 'smart' else None
+        if render == 'pipe':
+            pix_fmt = ffprobe.probe(path).pix_fmt
+            frames_read, frames_written, pump_time = video_render.render_pipe(path, kept_frames, frames, frame_rate, plan['width'], plan['height'], pix_fmt, path_out, audio)
+            print('Piped {} frames, kept {}, {:.1f} fps'.format(frames_read, frames_written, frames_read / max(pump_time, 1e-9)))
+            frame_size = video_render.FRAME_SIZES[video_render.get_pipe_format(pix_fmt)](plan['width'], plan['height'])
+            stage_metrics.add('decoder_bytes', frames_read * frame_size)
+            stage_metrics.add('encoder_bytes', frames_written * frame_size)
+            stage_metrics.set('frames_read', frames_read)
+        elif smart_cut_options is not None:
+            copied, encoded = video_render.render_smart_cut(path, kept_frames, frame_rate, smart_cut_options, ffprobe.get_keyframes(path), audio, path_out)
+            print('Copied {} pieces, encoded {} pieces'.format(copied, encoded))
+        elif render == 'filter' and render_workers != 1:
+            chunks = video_render.render_parallel(path, kept_frames, frame_rate, frames, plan['cut_frames'], audio, path_out, render_workers or None, executor, ffprobe.get_start_offset(path))
+            print('Rendered {} chunks'.format(chunks))
+        else:
+            if render == 'smart':
+                print('Smart cut does not support this codec, profile or pixel format, rendering with the filtergraph')
+            video_render.render_filtergraph(path, kept_frames, frame_rate, audio, path_out)
+    finally:
+        if audio_track is not None:
+            os.unlink(audio_track.name)
+    stage_metrics.set('output_bytes', os.path.getsize(path_out))
@@ -0,0 +1,124 @@
+import mmap
+
+import numpy as np
+
+import silence_detector
+
+
+BIN_DURATION = 0.001
+LEVEL_FACTOR = 4
+MIN_LEVEL_BINS = 0x100
+BLOCK_BINS = 0x1000
+
+
+class Envelope:
+    # Sums of squares of the audio per bin of about a millisecond, normalized to full scale, and
+    # coarser levels with LEVEL_FACTOR bins summed into one.
+
+    def __init__(self, frame_rate, size, bin_frames, levels):
+        self.frame_rate = frame_rate
+        self.size = size
+        self.bin_frames = bin_frames
+        self.levels = levels
+
+    def get_bin_frames(self, level=0):
+        return self.bin_frames * LEVEL_FACTOR ** level
+
+    def get_counts(self, level=0):
+        # Frames in every bin, the last one may be partial.
+        bin_frames = self.get_bin_frames(level)
+        counts = np.full(len(self.levels[level]), bin_frames, dtype=np.float64)
+        counts[-1] = self.size - (len(counts) - 1) * bin_frames
+        return counts
+
+
+def get_pyramid(sums):
+    levels = [ sums ]
+    while len(levels[-1]) >= MIN_LEVEL_BINS * LEVEL_FACTOR:
+        level = levels[-1]
+        padded = np.concatenate((level, np.zeros(-len(level) % LEVEL_FACTOR, dtype=level.dtype)))
+        levels.append(padded.reshape(-1, LEVEL_FACTOR).sum(axis=1, dtype=np.float64).astype(level.dtype))
+    return levels
+
+
+def build_envelope(filename, bin_duration=BIN_DURATION, block_bins=BLOCK_BINS):
+    # Reads the memory mapped data chunk of a WAV file once.
+    channels, sample_width, frame_rate, data_offset, data_length = silence_detector.get_data_chunk(filename)
+    frame_width = sample_width * channels
+    size = data_length // frame_width
+    bin_frames = max(int(round(bin_duration * frame_rate)), 1)
+    scale = float(channels * (1 << (8 * sample_width - 1)) ** 2)
+    sums = np.zeros(-(-size // bin_frames), dtype=np.float32)
+    block_frames = bin_frames * block_bins
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for block_start in range(0, size, block_frames):
+                block_end = min(block_start + block_frames, size)
+                values = silence_detector.decode_frames(data[data_offset+block_start*frame_width:data_offset+block_end*frame_width], sample_width, channels).astype(np.float64)
+                squares = (values * values).sum(axis=1)
+                bins = np.add.reduceat(squares, np.arange(0, len(squares), bin_frames))
+                sums[block_start//bin_frames:block_start//bin_frames+len(bins)] = bins / scale
+    return Envelope(frame_rate, size, bin_frames, get_pyramid(sums))
+
+
+def save_envelope(envelope, f):
+    arrays = { 'level{}'.format(index): level for index, level in enumerate(envelope.levels) }
+    np.savez(f, header=np.array([envelope.frame_rate, envelope.size, envelope.bin_frames], dtype=np.int64), **arrays)
+
+
+def load_envelope(f):
+    with np.load(f) as data:
+        frame_rate, size, bin_frames = ( int(value) for value in data['header'] )
+        levels = [ data['level{}'.format(index)] for index in range(len(data.files) - 1) ]
+    return Envelope(frame_rate, size, bin_frames, levels)
+
+
+def get_window_power(envelope, blend_duration=silence_detector.BLEND_DURATION, level=0):
+    # Mean power of the blend window around every bin, the window grows at the ends like in the detector.
+    half_blend_frames = silence_detector.get_half_blend_frames(envelope.frame_rate, blend_duration)
+    half_window = int(round(half_blend_frames / envelope.get_bin_frames(level)))
+    sums = envelope.levels[level].astype(np.float64)
+    counts = envelope.get_counts(level)
+    prefix_sums = np.concatenate(([0.0], np.cumsum(sums)))
+    prefix_counts = np.concatenate(([0.0], np.cumsum(counts)))
+    index = np.arange(len(sums))
+    lo = np.maximum(index - half_window, 0)
+    hi = np.minimum(index + half_window + 1, len(sums))
+    return (prefix_sums[hi] - prefix_sums[lo]) / (prefix_counts[hi] - prefix_counts[lo])
+
+
+def get_runs(envelope, window_power, threshold_level, level=0):
+    # Silent runs in audio frames, like the ones of the detector.
+    bin_frames = envelope.get_bin_frames(level)
+    runs = silence_detector.append_runs([], window_power < 10 ** (threshold_level / 10), 0)
+    return [ (start * bin_frames, min(end * bin_frames, envelope.size)) for start, end in runs ]
+
+
+def find_silences(envelope, threshold_level, threshold_duration, blend_duration=silence_detector.BLEND_DURATION, level=0):
+    # Same as detect_silences at the resolution of the envelope level, in seconds.
+    window_power = get_window_power(envelope, blend_duration, level)
+    runs = get_runs(envelope, window_power, threshold_level, level)
+    half_blend_frames = silence_detector.get_half_blend_frames(envelope.frame_rate, blend_duration)
+    threshold_frames = int(threshold_duration * envelope.frame_rate)
+    silence_regions, including_end = silence_detector.to_silence_regions(runs, envelope.size, half_blend_frames, threshold_frames, blend_duration)
+    return [ (start / envelope.frame_rate, end / envelope.frame_rate) for start, end in silence_regions ], including_end
+
+
+def sweep(envelope, threshold_levels, threshold_durations, transform_duration=None, blend_duration=silence_detector.BLEND_DURATION, level=0):
+    # Gap counts and removed seconds for every pair of thresholds, without transform_duration
+    # the gaps are removed completely.
+    window_power = get_window_power(envelope, blend_duration, level)
+    half_blend_frames = silence_detector.get_half_blend_frames(envelope.frame_rate, blend_duration)
+    results = []
+    for threshold_level in threshold_levels:
+        runs = get_runs(envelope, window_power, threshold_level, level)
+        for threshold_duration in threshold_durations:
+            threshold_frames = int(threshold_duration * envelope.frame_rate)
+            silence_regions, _ = silence_detector.to_silence_regions(runs, envelope.size, half_blend_frames, threshold_frames, blend_duration)
+            durations = [ (end - start) / envelope.frame_rate for start, end in silence_regions ]
+            if transform_duration is None:
+                removed = sum(durations)
+            else:
+                removed = sum( duration - transform_duration(duration) for duration in durations )
+            results.append({ 'threshold_level': threshold_level, 'threshold_duration': threshold_duration, 'gaps': len(durations), 'removed': removed })
+    return results
@@ -1,40 +1,145 @@
+import fractions
+import hashlib
 import json
+import os
 import subprocess
 
+import analysis_cache
+
+
+START_PACKETS = 32
+
+_probes = {}
+
+
+class MediaInfo:
+    # Metadata of the first video stream and the container from a single ffprobe run.
+    __slots__ = ('width', 'height', 'frames', 'duration', 'frame_rate', 'pix_fmt', 'codec_name', 'profile', 'level', 'has_audio', 'format_duration')
+
+    def __init__(self, probe_json):
+        streams = probe_json.get('streams', [])
+        video = next(( stream for stream in streams if stream['codec_type'] == 'video' ), None)
+        self.has_audio = any( stream['codec_type'] == 'audio' for stream in streams )
+        self.format_duration = float(probe_json['format']['duration']) if 'duration' in probe_json.get('format', {}) else None
+        self.width = self.height = self.frames = self.duration = self.frame_rate = self.pix_fmt = self.codec_name = self.profile = self.level = None
+        if video is None:
+            return
+        self.width = int(video['width'])
+        self.height = int(video['height'])
+        self.frames = int(video['nb_frames']) if 'nb_frames' in video else None
+        if 'duration' in video:
+            self.duration = float(video['duration'])
+        elif 'DURATION' in video.get('tags', {}):
+            parts = video['tags']['DURATION'].split(':')
+            assert len(parts) == 3
+            self.duration = float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
+        else:
+            self.duration = self.format_duration
+        if 'avg_frame_rate' in video:
+            assert video['avg_frame_rate'].count('/') <= 1
+            parts = video['avg_frame_rate'].split('/')
+            # ffprobe reports 0/0 when it does not know the rate.
+            if len(parts) == 1:
+                self.frame_rate = float(parts[0])
+            elif float(parts[1]) != 0:
+                self.frame_rate = float(parts[0]) / float(parts[1])
+        self.pix_fmt = video.get('pix_fmt')
+        self.codec_name = video.get('codec_name')
+        self.profile = video.get('profile')
+        self.level = video.get('level')
+
+    def __repr__(self):
+        return 'MediaInfo({})'.format(', '.join( '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__ ))
+
 
 def _get_json(path):
-    result = subprocess.run(['ffprobe', path, '-loglevel', 'quiet', '-print_format', 'json', '-show_streams'], stdout=subprocess.PIPE)
+    result = subprocess.run(['ffprobe', path, '-loglevel', 'quiet', '-print_format', 'json', '-show_streams', '-show_format'], stdout=subprocess.PIPE)
     result.check_returncode()
     return json.loads(result.stdout)
 
+def count_frames(path):
+    # Counts the packets of the first video stream, it only demuxes, so it is fast unlike -count_frames.
+    result = subprocess.run(['ffprobe', path, '-loglevel', 'quiet', '-print_format', 'json', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets'], stdout=subprocess.PIPE)
+    result.check_returncode()
+    streams = json.loads(result.stdout).get('streams', [])
+    if streams and 'nb_read_packets' in streams[0]:
+        return int(streams[0]['nb_read_packets'])
+
+def _store(name, probe_json, store_dir):
+    analysis_cache.store_file(name, lambda f: f.write(json.dumps(probe_json).encode('utf-8')), store_dir)
+
+def probe(path, exact_frames=False, store_dir=None):
+    # Memoized by path, mtime and size, with store_dir the ffprobe output is also kept in the analysis cache.
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    name = hashlib.sha256('{}|{}|{}'.format(*key).encode('utf-8')).hexdigest() + '.probe.json'
+    probe_json = _probes.get(key)
+    if probe_json is None and store_dir is not None:
+        filename = analysis_cache.get_file(name, store_dir)
+        if filename is not None:
+            with open(filename, encoding='utf-8') as f:
+                probe_json = json.load(f)
+    if probe_json is None:
+        probe_json = _get_json(path)
+        if store_dir is not None:
+            _store(name, probe_json, store_dir)
+    _probes[key] = probe_json
+    info = MediaInfo(probe_json)
+    if exact_frames and info.frames is None and info.width is not None:
+        info.frames = count_frames(path)
+        if info.frames is not None:
+            # The count is kept with the probe, so it is not repeated.
+            next( stream for stream in probe_json['streams'] if stream['codec_type'] == 'video' )['nb_frames'] = str(info.frames)
+            if store_dir is not None:
+                _store(name, probe_json, store_dir)
+    return info
+
 def get_resolution(path):
-    for stream in _get_json(path)['streams']:
-        if stream['codec_type'] == 'video':
-            return stream['width'], stream['height']
+    info = probe(path)
+    if info.width is not None:
+        return info.width, info.height
 
 def get_frames(path):
-    for stream in _get_json(path)['streams']:
-        if stream['codec_type'] == 'video':
-            if 'nb_frames' in stream:
-                return int(stream['nb_frames'])
+    return probe(path).frames
 
 def get_duration(path):
-    for stream in _get_json(path)['streams']:
-        if stream['codec_type'] == 'video':
-            if 'duration' in stream:
-                return float(stream['duration'])
-            else:
-                parts = stream['tags']['DURATION'].split(':')
-                assert len(parts) == 3
-                return float(parts[0]) * 3600 + float(parts[1]) * 60 + float(parts[2])
+    return probe(path).duration
 
 def get_frame_rate(path):
-    for stream in _get_json(path)['streams']:
-        if stream['codec_type'] == 'video':
-            if 'avg_frame_rate' in stream:
-                assert stream['avg_frame_rate'].count('/') <= 1
-                parts = stream['avg_frame_rate'].split('/')
-                result = float(parts[0])
-                if len(parts) == 2:
-                    result /= float(parts[1])
-                return result
+    return probe(path).frame_rate
+
+def get_pix_fmt(path):
+    return probe(path).pix_fmt
+
+def get_codec_name(path):
+    return probe(path).codec_name
+
+def _get_packets(path, read_intervals=None):
+    # pts of the packets of the first video stream in seconds from the container start time, which is where -ss of
+    # an input counts from, as exact fractions, with the flags of each.
+    command = ['ffprobe', path, '-loglevel', 'quiet', '-print_format', 'json', '-select_streams', 'v:0', '-show_entries', 'packet=pts,flags:stream=time_base:format=start_time']
+    if read_intervals is not None:
+        command += ['-read_intervals', read_intervals]
+    result = subprocess.run(command, stdout=subprocess.PIPE)
+    result.check_returncode()
+    probe_json = json.loads(result.stdout)
+    packets = [ packet for packet in probe_json.get('packets', []) if packet.get('pts', 'N/A') != 'N/A' ]
+    if not packets:
+        return []
+    time_base = fractions.Fraction(probe_json['streams'][0]['time_base'])
+    start_time = probe_json.get('format', {}).get('start_time', 'N/A')
+    start_time = 0 if start_time == 'N/A' else fractions.Fraction(start_time)
+    return [ (int(packet['pts']) * time_base - start_time, packet.get('flags', '')) for packet in packets ]
+
+def get_start_offset(path):
+    # Time of the first frame of the first video stream, it has the lowest pts of the first packets, which are in
+    # decoding order.
+    packets = _get_packets(path, '%+#{}'.format(START_PACKETS))
+    return min(time for time, _ in packets) if packets else 0
+
+def get_keyframes(path):
+    # Exact times of the first frame and of the keyframes of the first video stream.
+    packets = _get_packets(path)
+    if not packets:
+        return 0, []
+    return min(time for time, _ in packets), sorted(time for time, flags in packets if 'K' in flags)
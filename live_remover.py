@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import os
+import queue
+import subprocess
+import threading
+import time
+import types
+
+import ffprobe
+import silence_detector
+import video_render
+from batch_silence_remover import transform_duration
+from cut_plan import closest_frames
+
+
+AUDIO_FRAME_RATE = 48000
+AUDIO_CHANNELS = 2
+AUDIO_READ_SIZE = 0x1000
+QUEUE_SIZE = 64
+IDLE_TIMEOUT = 10
+
+
+class LivePlanner:
+    # Decides online which video frames are kept, with a lookahead of threshold_duration and half a blend window.
+    # A silence is compressed while it goes on: after e of its frames, closest_frames(transform(e)) are kept.
+    # The audio of a kept frame is its 1/frame_rate slice, so audio and video stay in sync.
+
+    def __init__(self, frame_rate, audio_frame_rate, channels, threshold_level, threshold_duration, transform, blend_duration=silence_detector.BLEND_DURATION):
+        self.frame_rate = frame_rate
+        self.audio_frame_rate = audio_frame_rate
+        self.frame_width = 2 * channels
+        self.transform = transform
+        self.detector = silence_detector.SilenceDetector(channels, 2, audio_frame_rate, threshold_level, blend_duration)
+        self.half_blend_frames = self.detector.half_blend_frames
+        self.threshold_frames = int(threshold_duration * audio_frame_rate)
+        self.audio = bytearray()
+        self.audio_start = 0
+        self.frames = collections.deque()
+        self.next_frame = 0
+        self.finished = False
+        self.silence_start = None
+        self.silence_kept = 0
+
+    def feed_audio(self, data):
+        self.detector.feed(data)
+        self.audio += data
+
+    def feed_frame(self, frame, arrival):
+        self.frames.append((frame, arrival))
+
+    def finish(self):
+        if self.detector.size > 2 * self.half_blend_frames:
+            self.detector.finish()
+        else:
+            # Too short for the blend window, everything is kept.
+            self.detector.runs.clear()
+            self.detector.done = self.detector.size
+        self.finished = True
+
+    def to_video_frame(self, audio_frame):
+        return int(audio_frame / self.audio_frame_rate * self.frame_rate)
+
+    def get_audio_slice(self, index):
+        start = int(index * self.audio_frame_rate / self.frame_rate)
+        end = int((index + 1) * self.audio_frame_rate / self.frame_rate)
+        if end > self.detector.size and not self.finished:
+            return None
+        data = self.audio[(start-self.audio_start)*self.frame_width:(end-self.audio_start)*self.frame_width]
+        # The video may be longer than the audio.
+        return bytes(data) + bytes((end - start) * self.frame_width - len(data))
+
+    def classify(self, index):
+        # True when frame index is in a silence, False when it is not and None when it is not decided yet.
+        runs = self.detector.runs
+        done = self.detector.done
+        h = self.half_blend_frames
+        while runs:
+            start, end = runs[0]
+            is_open = end == done and not self.finished
+            silence_start = start + (h if start > 0 else 0)
+            if is_open:
+                if index < self.to_video_frame(silence_start):
+                    return False
+                if done - h - silence_start < self.threshold_frames:
+                    return None
+                return True if index < self.to_video_frame(done - h) else None
+            silence_end = end - (h if end < self.detector.size else 0)
+            if silence_end - silence_start >= self.threshold_frames:
+                if index < self.to_video_frame(silence_end):
+                    return index >= self.to_video_frame(silence_start)
+            elif index < self.to_video_frame(silence_start):
+                return False
+            # The run is behind the frame, runs only grow at the end, so it is not needed any more.
+            del runs[0]
+        # Silences that are not found yet start after done.
+        if self.finished or index < self.to_video_frame(done):
+            return False
+        return None
+
+    def decide(self):
+        # Yields (frame, audio, arrival) of kept frames and None for dropped ones, as far as they can be decided.
+        while self.frames:
+            index = self.next_frame
+            in_silence = self.classify(index)
+            if in_silence is None:
+                return
+            audio = self.get_audio_slice(index)
+            if audio is None:
+                return
+            frame, arrival = self.frames.popleft()
+            self.next_frame += 1
+            if in_silence:
+                start = self.silence_start_frame(index)
+                kept_count = closest_frames(self.transform((index - start + 1) / self.frame_rate), self.frame_rate)
+                keep = self.silence_kept < kept_count
+                if keep:
+                    self.silence_kept += 1
+            else:
+                self.silence_start = None
+                keep = True
+            self.release_audio(int(self.next_frame * self.audio_frame_rate / self.frame_rate))
+            yield (frame, audio, arrival) if keep else None
+
+    def silence_start_frame(self, index):
+        if self.silence_start is None:
+            self.silence_start = index
+            self.silence_kept = 0
+        return self.silence_start
+
+    def release_audio(self, audio_frame):
+        if audio_frame > self.audio_start:
+            del self.audio[:(audio_frame-self.audio_start)*self.frame_width]
+            self.audio_start = audio_frame
+
+
+def _read_stream(source, size, kind, events):
+    try:
+        while True:
+            data = source.read(size)
+            if not data:
+                break
+            events.put((kind, data))
+    except BaseException as e:
+        events.put(('error', e))
+    finally:
+        events.put((kind, None))
+
+
+def _write_stream(sink, items, errors):
+    try:
+        while True:
+            data = items.get()
+            if data is None:
+                break
+            sink.write(data)
+    except BaseException as e:
+        errors.append(e)
+        # Keep draining, so the planner is not blocked on a full queue.
+        while items.get() is not None:
+            pass
+    finally:
+        try:
+            sink.close()
+        except BrokenPipeError:
+            pass
+
+
+def get_decoder_command(source, width, height, frame_rate, audio_fd, follow=False, idle_timeout=IDLE_TIMEOUT):
+    command = [ 'ffmpeg', '-loglevel', 'error' ]
+    if source == '-':
+        command += [ '-i', 'pipe:0' ]
+    elif follow:
+        # Reads a file that is still written, until it has not grown for idle_timeout seconds.
+        command += [ '-follow', '1', '-rw_timeout', str(int(idle_timeout * 1e6)), '-i', 'file:' + source ]
+    else:
+        command += [ '-i', source ]
+    command += [ '-map', '0:v:0', '-r', str(frame_rate), '-s', '{}x{}'.format(width, height), '-pix_fmt', 'yuv420p', '-f', 'rawvideo', 'pipe:1' ]
+    command += [ '-map', '0:a:0', '-ac', str(AUDIO_CHANNELS), '-ar', str(AUDIO_FRAME_RATE), '-f', 's16le', 'pipe:{}'.format(audio_fd) ]
+    return command
+
+
+def get_encoder_command(path_out, width, height, frame_rate, audio_fd, segment_time=None):
+    command = [ 'ffmpeg', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'yuv420p', '-s', '{}x{}'.format(width, height), '-framerate', str(frame_rate), '-i', 'pipe:0' ]
+    command += [ '-f', 's16le', '-ar', str(AUDIO_FRAME_RATE), '-ac', str(AUDIO_CHANNELS), '-i', 'pipe:{}'.format(audio_fd) ]
+    command += [ '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac' ]
+    if segment_time:
+        # path_out is a pattern like out%05d.ts, every segment is complete when the next one starts.
+        command += [ '-f', 'segment', '-segment_time', str(segment_time), '-reset_timestamps', '1' ]
+    elif path_out.endswith('.mp4'):
+        # Fragments can be read while the file is written.
+        command += [ '-movflags', '+frag_keyframe+empty_moov' ]
+    return command + [ '-y', path_out ]
+
+
+def remove_silences_live(
+    source,
+    path_out,
+    width=None,
+    height=None,
+    frame_rate=None,
+    threshold_level=-40,
+    threshold_duration=0.2,
+    constant=0,
+    sublinear=0,
+    linear=0.1,
+    follow=False,
+    idle_timeout=IDLE_TIMEOUT,
+    segment_time=None
+    ):
+    # Removes silences from a pipe ('-' for stdin) or a growing file while it is read, the memory does not
+    # depend on the length of the session. Returns frames read and kept, seconds and frame latencies.
+    if width is None or height is None or frame_rate is None:
+        assert source != '-', 'width, height and frame rate of a pipe have to be given'
+        info = ffprobe.probe(source)
+        width = width or info.width
+        height = height or info.height
+        frame_rate = frame_rate or info.frame_rate
+    transform_args = types.SimpleNamespace(constant=constant, sublinear=sublinear, linear=linear)
+    planner = LivePlanner(frame_rate, AUDIO_FRAME_RATE, AUDIO_CHANNELS, threshold_level, threshold_duration, lambda duration: transform_duration(duration, transform_args))
+    frame_size = video_render.FRAME_SIZES['yuv420p'](width, height)
+
+    decoder_audio, decoder_audio_out = os.pipe()
+    decoder = subprocess.Popen(get_decoder_command(source, width, height, frame_rate, decoder_audio_out, follow, idle_timeout), stdout=subprocess.PIPE, pass_fds=(decoder_audio_out,))
+    os.close(decoder_audio_out)
+    encoder_audio_in, encoder_audio = os.pipe()
+    encoder = subprocess.Popen(get_encoder_command(path_out, width, height, frame_rate, encoder_audio_in, segment_time), stdin=subprocess.PIPE, pass_fds=(encoder_audio_in,))
+    os.close(encoder_audio_in)
+
+    events = queue.Queue(maxsize=QUEUE_SIZE)
+    video_out = queue.Queue(maxsize=QUEUE_SIZE)
+    audio_out = queue.Queue(maxsize=QUEUE_SIZE)
+    errors = []
+    threads = [
+        threading.Thread(target=_read_stream, args=(decoder.stdout, frame_size, 'video', events)),
+        threading.Thread(target=_read_stream, args=(os.fdopen(decoder_audio, 'rb'), AUDIO_READ_SIZE, 'audio', events)),
+        threading.Thread(target=_write_stream, args=(encoder.stdin, video_out, errors)),
+        threading.Thread(target=_write_stream, args=(os.fdopen(encoder_audio, 'wb'), audio_out, errors)),
+    ]
+    for thread in threads:
+        thread.start()
+
+    stats = { 'frames_read': 0, 'frames_kept': 0, 'max_latency': 0.0, 'total_latency': 0.0, 'max_pending_frames': 0 }
+
+    def emit(decisions):
+        for decision in decisions:
+            if decision is None:
+                continue
+            frame, audio, arrival = decision
+            # Audio goes first, so the encoder never waits for the audio of a queued frame.
+            audio_out.put(audio)
+            video_out.put(frame)
+            latency = time.perf_counter() - arrival
+            stats['frames_kept'] += 1
+            stats['max_latency'] = max(stats['max_latency'], latency)
+            stats['total_latency'] += latency
+
+    time_start = time.perf_counter()
+    try:
+        streams = 2
+        while streams:
+            kind, data = events.get()
+            if kind == 'error':
+                raise data
+            if data is None:
+                streams -= 1
+                continue
+            if kind == 'audio':
+                planner.feed_audio(data)
+            elif len(data) == frame_size:
+                planner.feed_frame(data, time.perf_counter())
+                stats['frames_read'] += 1
+                stats['max_pending_frames'] = max(stats['max_pending_frames'], len(planner.frames))
+            emit(planner.decide())
+        planner.finish()
+        emit(planner.decide())
+    finally:
+        video_out.put(None)
+        audio_out.put(None)
+        for thread in threads[2:]:
+            thread.join()
+        encoder.wait()
+        if decoder.poll() is None:
+            decoder.terminate()
+        decoder.wait()
+        # After an error the readers may wait for room in the queue.
+        while any( thread.is_alive() for thread in threads[:2] ):
+            try:
+                events.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
+    if encoder.returncode != 0:
+        raise subprocess.CalledProcessError(encoder.returncode, 'ffmpeg')
+    stats['seconds'] = time.perf_counter() - time_start
+    stats['mean_latency'] = stats['total_latency'] / max(stats['frames_kept'], 1)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str, help='path to a video that may still be written, - for stdin')
+    parser.add_argument('path_out', type=str, help='path to the result, a pattern like out%%05d.ts with --segment-time')
+    parser.add_argument('--size', type=str, help='WIDTHxHEIGHT of the video, needed for stdin')
+    parser.add_argument('--frame-rate', type=float, help='frame rate of the video, needed for stdin')
+    parser.add_argument('--threshold-level', type=float, default=-40, help='threshold level in dB')
+    parser.add_argument('--threshold-duration', type=float, default=0.2, help='threshold duration in seconds')
+    parser.add_argument('--constant', type=float, default=0, help='duration constant transform value')
+    parser.add_argument('--sublinear', type=float, default=0, help='duration sublinear transform factor')
+    parser.add_argument('--linear', type=float, default=0.1, help='duration linear transform factor')
+    parser.add_argument('--follow', action='store_true', help='read a file that is still written')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, help='seconds without new data that end --follow')
+    parser.add_argument('--segment-time', type=float, help='write segments of about this many seconds')
+    args = parser.parse_args()
+    width, height = ( int(value) for value in args.size.split('x') ) if args.size else (None, None)
+    stats = remove_silences_live(args.source, args.path_out, width, height, args.frame_rate, args.threshold_level, args.threshold_duration,
+        args.constant, args.sublinear, args.linear, args.follow, args.idle_timeout, args.segment_time)
+    print('Read {} frames, kept {}, {:.1f} fps, latency {:.3f} s mean, {:.3f} s max'.format(stats['frames_read'], stats['frames_kept'],
+        stats['frames_read'] / max(stats['seconds'], 1e-9), stats['mean_latency'], stats['max_latency']))
+
+
+if __name__ == "__main__":
+    main()
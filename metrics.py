@@ -0,0 +1,81 @@
+import cProfile
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+class Metrics:
+    # Wall, CPU and child process times of consecutive stages, and counters. callback(stage, values) is
+    # called when a stage ends and with the 'total' stage and the whole report at finish.
+
+    def __init__(self, callback=None, profile=None):
+        self.callback = callback
+        self.profile = profile
+        self.profiler = cProfile.Profile() if profile else None
+        self.stages = {}
+        self.counters = {}
+        self._stage = None
+        self._start = self._get_times()
+
+    def _get_times(self):
+        times = os.times()
+        return time.perf_counter(), time.process_time(), times.children_user + times.children_system
+
+    def begin(self, stage):
+        # Ends the current stage and starts the next one.
+        self.end()
+        self._stage = stage, self._get_times()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def end(self):
+        if self._stage is None:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        stage, start = self._stage
+        self._stage = None
+        wall, cpu, children = ( end - start for end, start in zip(self._get_times(), start) )
+        values = self.stages.setdefault(stage, { 'wall': 0.0, 'cpu': 0.0, 'children_cpu': 0.0 })
+        values['wall'] += wall
+        values['cpu'] += cpu
+        values['children_cpu'] += children
+        if self.callback is not None:
+            self.callback(stage, values)
+
+    def add(self, counter, value):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, counter, value):
+        self.counters[counter] = value
+
+    def finish(self, filename=None):
+        self.end()
+        wall, cpu, children = ( end - start for end, start in zip(self._get_times(), self._start) )
+        report = {
+            'stages': self.stages,
+            'counters': self.counters,
+            'wall': wall,
+            'cpu': cpu,
+            'children_cpu': children,
+        }
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux.
+            report['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            report['children_peak_rss'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        if 'media_duration' in self.counters and wall > 0:
+            report['realtime_factor'] = self.counters['media_duration'] / wall
+        if self.profiler is not None:
+            self.profiler.dump_stats(self.profile)
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(report, f, indent=2)
+        if self.callback is not None:
+            self.callback('total', report)
+        return report
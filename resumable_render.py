@@ -0,0 +1,190 @@
+import concurrent.futures
+import hashlib
+import json
+import math
+import os
+import subprocess
+
+import audio_assembly
+import cut_plan
+import ffprobe
+import metrics
+import video_render
+
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+PLAN_NAME = 'plan.json'
+AUDIO_NAME = 'audio.wav'
+TMP_SUFFIX = '.tmp'
+SEGMENT_DURATION = 600
+READ_SIZE = 1 << 20
+
+
+def get_job_dir(path_out):
+    return path_out + '.parts'
+
+
+def hash_file(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_plan_hash(plan):
+    # Segments are only reused for the same source and the same cuts.
+    source = [ plan['path'], plan['frames'], plan['frame_rate'], plan['kept_frames'], plan['audio_regions'] ]
+    return hashlib.sha256(json.dumps(source).encode('utf-8')).hexdigest()
+
+
+def _write_json(filename, value):
+    with open(filename + TMP_SUFFIX, 'w', encoding='utf-8') as f:
+        json.dump(value, f, indent=1)
+    os.replace(filename + TMP_SUFFIX, filename)
+
+
+def load_manifest(job_dir, plan_hash):
+    # A manifest of another version or plan is dropped with all of its files.
+    try:
+        with open(os.path.join(job_dir, MANIFEST_NAME), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('plan_hash') != plan_hash:
+        return None
+    return manifest
+
+
+def is_valid(job_dir, entry):
+    filename = os.path.join(job_dir, entry['file'])
+    try:
+        if os.path.getsize(filename) != entry['size']:
+            return False
+    except OSError:
+        return False
+    return hash_file(filename) == entry['sha256']
+
+
+def clean(job_dir, manifest):
+    # Removes what a killed run leaves behind: temp files and files the manifest does not list.
+    keep = { MANIFEST_NAME, PLAN_NAME } | { entry['file'] for entry in manifest['files'].values() }
+    for name in os.listdir(job_dir):
+        if name not in keep:
+            os.unlink(os.path.join(job_dir, name))
+
+
+def commit(job_dir, manifest, name, write):
+    # write(filename) makes the file under a temp name, it is renamed into place and listed only when complete.
+    tmp_name = os.path.join(job_dir, name + TMP_SUFFIX)
+    try:
+        write(tmp_name)
+        entry = { 'file': name, 'size': os.path.getsize(tmp_name), 'sha256': hash_file(tmp_name) }
+        os.replace(tmp_name, os.path.join(job_dir, name))
+    finally:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+    manifest['files'][name] = entry
+    _write_json(os.path.join(job_dir, MANIFEST_NAME), manifest)
+
+
+def get_segments(plan, segment_duration=SEGMENT_DURATION):
+    # Segments start at silences like the chunks of render_parallel, so their bounds do not depend on the workers.
+    frames = plan['frames']
+    count = max(int(math.ceil(frames / plan['frame_rate'] / segment_duration)), 1)
+    segments = []
+    for start, end in video_render.split_chunks(plan['cut_frames'], frames, count):
+        ranges = video_render.clip_ranges(plan['kept_frames'], start, end)
+        if ranges:
+            segments.append(('{:09d}-{:09d}.mp4'.format(start, end), start, end, ranges))
+    return segments
+
+
+def render_resumable(plan, wav, path, path_out, job_dir=None, segment_duration=SEGMENT_DURATION, workers=1, transcription_audio=None, stage_metrics=None, executor=None):
+    # Renders segments into job_dir, every one committed to the manifest when it is complete. A rerun with the same
+    # plan renders only missing or corrupt segments, then joins them. job_dir is removed when path_out is written.
+    # Returns (segments rendered, segments reused).
+    job_dir = job_dir or get_job_dir(path_out)
+    if stage_metrics is None:
+        stage_metrics = metrics.Metrics()
+    stage_metrics.begin('resume')
+    os.makedirs(job_dir, exist_ok=True)
+    plan_hash = get_plan_hash(plan)
+    manifest = load_manifest(job_dir, plan_hash)
+    if manifest is None:
+        manifest = { 'version': MANIFEST_VERSION, 'plan_hash': plan_hash, 'files': {} }
+    manifest['files'] = { name: entry for name, entry in manifest['files'].items() if is_valid(job_dir, entry) }
+    clean(job_dir, manifest)
+    _write_json(os.path.join(job_dir, MANIFEST_NAME), manifest)
+    with open(os.path.join(job_dir, PLAN_NAME), 'w', encoding='utf-8') as f:
+        cut_plan.save_plan(plan, f)
+
+    audio_path = os.path.join(job_dir, AUDIO_NAME)
+    if AUDIO_NAME not in manifest['files']:
+        stage_metrics.begin('assemble_audio')
+        def write_audio(filename):
+            with open(filename, 'wb') as f:
+                audio_assembly.write_wav(wav, plan['audio_regions'], f)
+        commit(job_dir, manifest, AUDIO_NAME, write_audio)
+        stage_metrics.add('encoder_bytes', os.path.getsize(audio_path))
+
+    if transcription_audio:
+        stage_metrics.begin('transcription_audio')
+        with audio_assembly.MappedWave(audio_path) as track:
+            audio_assembly.write_transcription_audio(track, transcription_audio)
+
+    stage_metrics.begin('render')
+    segments = get_segments(plan, segment_duration)
+    pending = [ segment for segment in segments if segment[0] not in manifest['files'] ]
+    print('Rendering {} of {} segments'.format(len(pending), len(segments)))
+    frame_rate = plan['frame_rate']
+    first_time = ffprobe.get_start_offset(path) if pending else 0
+    if workers == 1 and executor is None:
+        for name, start, end, ranges in pending:
+            commit(job_dir, manifest, name, lambda filename: video_render.render_chunk(path, ranges, frame_rate, start, end, filename, first_time))
+    else:
+        # Segments are encoded concurrently, the manifest is only written from this thread.
+        own_executor = executor is None
+        if own_executor:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        try:
+            futures = {}
+            for name, start, end, ranges in pending:
+                tmp_name = os.path.join(job_dir, name + '.part' + TMP_SUFFIX)
+                futures[executor.submit(video_render.render_chunk, path, ranges, frame_rate, start, end, tmp_name, first_time)] = name, tmp_name
+            errors = []
+            for future in concurrent.futures.as_completed(futures):
+                name, tmp_name = futures[future]
+                if future.exception() is not None:
+                    # The other segments are still committed, so a rerun does not render them again.
+                    errors.append(future.exception())
+                    continue
+                commit(job_dir, manifest, name, lambda filename: os.replace(tmp_name, filename))
+            if errors:
+                raise errors[0]
+        finally:
+            if own_executor:
+                executor.shutdown()
+
+    stage_metrics.begin('join')
+    list_path = os.path.join(job_dir, 'segments.ffconcat' + TMP_SUFFIX)
+    with open(list_path, 'w') as list_file:
+        list_file.write('ffconcat version 1.0\n')
+        for name, _, _, _ in segments:
+            list_file.write("file '{}'\n".format(name))
+    name, extension = os.path.splitext(path_out)
+    tmp_out = name + TMP_SUFFIX + extension
+    try:
+        command = [ 'ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_path, '-f', 'wav', '-i', audio_path ]
+        command += [ '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-y', tmp_out ]
+        subprocess.run(command).check_returncode()
+        os.replace(tmp_out, path_out)
+    finally:
+        if os.path.exists(tmp_out):
+            os.unlink(tmp_out)
+    for name in os.listdir(job_dir):
+        os.unlink(os.path.join(job_dir, name))
+    os.rmdir(job_dir)
+    stage_metrics.set('output_bytes', os.path.getsize(path_out))
+    return len(pending), len(segments) - len(pending)
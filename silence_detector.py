@@ -0,0 +1,245 @@
+import concurrent.futures
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+BLEND_DURATION = 0.005
+BLOCK_FRAMES = 0x40000
+
+
+def get_half_blend_frames(frame_rate, blend_duration=BLEND_DURATION):
+    return int(blend_duration * frame_rate / 2)
+
+
+def get_channel_threshold(threshold_level, sample_width, channels):
+    max_value = 1 << (8 * sample_width - 1)
+    square_threshold = max_value ** 2 * 10 ** (threshold_level / 10)
+    return square_threshold * channels
+
+
+def is_exact_int64(sample_width, channels, half_blend_frames):
+    # Window sums have to fit into int64, otherwise we fall back to python ints.
+    max_value = 1 << (8 * sample_width - 1)
+    return (2 * half_blend_frames + 1) * channels * max_value ** 2 < 1 << 62
+
+
+def decode_frames(data, sample_width, channels):
+    # Samples are read as signed little endian for every width, 8 bit included, like int.from_bytes does.
+    if sample_width == 1:
+        values = np.frombuffer(data, dtype=np.int8)
+    elif sample_width == 2:
+        values = np.frombuffer(data, dtype='<i2')
+    elif sample_width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        values = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        values = (values ^ 0x800000) - 0x800000
+    elif sample_width == 4:
+        values = np.frombuffer(data, dtype='<i4')
+    else:
+        raise ValueError('unsupported sample width: {}'.format(sample_width))
+    return values.reshape(-1, channels)
+
+
+def frame_squares(data, sample_width, channels, exact=True):
+    values = decode_frames(data, sample_width, channels)
+    values = values.astype(np.int64 if exact else object)
+    return (values * values).sum(axis=1)
+
+
+def silence_mask(squares, offset, start, end, size, half_blend_frames, channel_threshold):
+    # squares[i] is the sum of squares of frame offset+i, it has to cover [max(start-h, 0), min(end+h, size)).
+    # The window is the one of the original moving sum: it grows at the start, and at the end it
+    # shrinks one frame earlier than its threshold does.
+    h = half_blend_frames
+    index = np.arange(start, end, dtype=np.int64)
+    lo = np.where(index < size - h, np.maximum(index - h, 0), index - h + 1)
+    hi = np.minimum(index + h + 1, size)
+    counts = np.where(index < h, h + index + 1, np.where(index < size - h, 2 * h + 1, size + h - index))
+    prefix = np.zeros(len(squares) + 1, dtype=squares.dtype)
+    # int64 cumsum may wrap around, the differences of windows that fit into int64 are still exact.
+    np.cumsum(squares, out=prefix[1:])
+    blend = prefix[hi - offset] - prefix[lo - offset]
+    thresholds = channel_threshold * counts.astype(np.float64)
+    if blend.dtype == object:
+        return np.asarray(blend < thresholds.astype(object), dtype=bool)
+    # blend < threshold <=> blend < ceil(threshold) for integers, this avoids rounding blend to float.
+    limits = np.minimum(np.ceil(thresholds), float(1 << 62)).astype(np.int64)
+    return blend < limits
+
+
+def append_runs(runs, mask, offset):
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    for start, end in zip(edges[::2], edges[1::2]):
+        start, end = int(start) + offset, int(end) + offset
+        if runs and runs[-1][1] == start:
+            runs[-1] = (runs[-1][0], end)
+        else:
+            runs.append((start, end))
+    return runs
+
+
+def merge_runs(*run_lists):
+    runs = []
+    for run_list in run_lists:
+        for start, end in run_list:
+            if runs and runs[-1][1] == start:
+                runs[-1] = (runs[-1][0], end)
+            else:
+                runs.append((start, end))
+    return runs
+
+
+def to_silence_regions(runs, size, half_blend_frames, threshold_frames, blend_duration=BLEND_DURATION):
+    silence_regions = ( (start, end) for start, end in runs if end-start >= blend_duration )
+    silence_regions = ( (start + (half_blend_frames if start > 0 else 0), end - (half_blend_frames if end < size else 0)) for start, end in silence_regions )
+    silence_regions = [ (start, end) for start, end in silence_regions if end-start >= threshold_frames ]
+    including_end = len(silence_regions) == 0 or silence_regions[-1][1] == size
+    return silence_regions, including_end
+
+
+class SilenceDetector:
+
+    def __init__(self, channels, sample_width, frame_rate, threshold_level, blend_duration=BLEND_DURATION):
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frame_rate = frame_rate
+        self.blend_duration = blend_duration
+        self.half_blend_frames = get_half_blend_frames(frame_rate, blend_duration)
+        self.channel_threshold = get_channel_threshold(threshold_level, sample_width, channels)
+        self.exact = is_exact_int64(sample_width, channels, self.half_blend_frames)
+        self.runs = []
+        self.size = 0
+        self._pending = b''
+        self._squares = np.zeros(0, dtype=np.int64 if self.exact else object)
+        self._offset = 0
+        self.done = 0
+
+    def feed(self, data):
+        frame_width = self.sample_width * self.channels
+        if self._pending:
+            data = self._pending + data
+        tail = len(data) % frame_width
+        self._pending = bytes(data[len(data)-tail:]) if tail else b''
+        data = data[:len(data)-tail]
+        if not data:
+            return
+        self._squares = np.concatenate((self._squares, frame_squares(data, self.sample_width, self.channels, self.exact)))
+        self.size += len(data) // frame_width
+        # A frame can be decided once the frames of its right half window have arrived.
+        self._advance(self.size - self.half_blend_frames, self.size)
+
+    def finish(self):
+        assert self.size > 2 * self.half_blend_frames > 0
+        self._advance(self.size, self.size)
+        return self.runs
+
+    def _advance(self, ready, size):
+        if ready <= self.done:
+            return
+        mask = silence_mask(self._squares, self._offset, self.done, ready, size, self.half_blend_frames, self.channel_threshold)
+        append_runs(self.runs, mask, self.done)
+        self.done = ready
+        offset = max(ready - self.half_blend_frames, 0)
+        self._squares = self._squares[offset-self._offset:]
+        self._offset = offset
+
+
+def detect_silences(wav, threshold_level, threshold_duration, blend_duration=BLEND_DURATION, block_frames=BLOCK_FRAMES):
+    size = wav.getnframes()
+    frame_rate = wav.getframerate()
+    detector = SilenceDetector(wav.getnchannels(), wav.getsampwidth(), frame_rate, threshold_level, blend_duration)
+    wav.rewind()
+    frames_read = 0
+    while frames_read < size:
+        frames = wav.readframes(min(block_frames, size - frames_read))
+        if not frames:
+            break
+        detector.feed(frames)
+        frames_read = detector.size
+    runs = detector.finish()
+    threshold_frames = int(threshold_duration * frame_rate)
+    return to_silence_regions(runs, detector.size, detector.half_blend_frames, threshold_frames, blend_duration)
+
+
+def read_wav_header(f):
+    # Reads the header up to the PCM data, f may be a pipe, so chunks are skipped by reading.
+    # RF64 files keep the 64 bit size of a data chunk over 4 GiB in their ds64 chunk.
+    riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+        raise ValueError('not a WAV stream')
+    fmt = None
+    data_size = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('no data chunk in WAV stream')
+        chunk_id, chunk_size = struct.unpack('<4sI', header)
+        if chunk_id == b'data':
+            assert fmt is not None
+            if chunk_size == 0xFFFFFFFF and data_size is not None:
+                chunk_size = data_size
+            return fmt + (chunk_size,)
+        chunk = f.read(chunk_size + (chunk_size & 1))
+        if chunk_id == b'fmt ':
+            _, channels, frame_rate, _, _, bits = struct.unpack('<HHIIHH', chunk[:16])
+            fmt = channels, (bits + 7) // 8, frame_rate
+        elif chunk_id == b'ds64':
+            _, data_size = struct.unpack('<QQ', chunk[:16])
+
+
+def get_data_chunk(filename):
+    # Returns format and position of the PCM data chunk, so it can be memory mapped.
+    with open(filename, 'rb') as f:
+        channels, sample_width, frame_rate, data_length = read_wav_header(f)
+        offset = f.tell()
+        length = os.fstat(f.fileno()).st_size - offset
+        if data_length < length and (length - data_length) % (1 << 32) == 0:
+            # A plain RIFF writer stored the size of a data chunk over 4 GiB modulo 2**32, it runs to the end of the file.
+            data_length = length
+        return channels, sample_width, frame_rate, offset, min(data_length, length)
+
+
+def analyze_range(data, data_offset, sample_width, channels, size, start, end, half_blend_frames, channel_threshold, block_frames=BLOCK_FRAMES):
+    # Silent runs of frames [start, end) of PCM data with size frames starting at byte data_offset.
+    frame_width = sample_width * channels
+    exact = is_exact_int64(sample_width, channels, half_blend_frames)
+    runs = []
+    for block_start in range(start, end, block_frames):
+        block_end = min(block_start + block_frames, end)
+        offset = max(block_start - half_blend_frames, 0)
+        data_end = min(block_end + half_blend_frames, size)
+        squares = frame_squares(data[data_offset+offset*frame_width:data_offset+data_end*frame_width], sample_width, channels, exact)
+        mask = silence_mask(squares, offset, block_start, block_end, size, half_blend_frames, channel_threshold)
+        append_runs(runs, mask, block_start)
+    return runs
+
+
+def _analyze_shard(filename, data_offset, sample_width, channels, size, start, end, half_blend_frames, channel_threshold):
+    # Blocks read half a blend window over the shard borders, so every frame sees the same window as in a serial run.
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return analyze_range(data, data_offset, sample_width, channels, size, start, end, half_blend_frames, channel_threshold)
+
+
+def detect_silences_parallel(filename, threshold_level, threshold_duration, blend_duration=BLEND_DURATION, workers=None, shard_frames=None, executor=None):
+    # Same result as detect_silences, the memory mapped data chunk is analyzed in shards on a process pool.
+    # A given executor is used instead of a new pool and stays open.
+    channels, sample_width, frame_rate, data_offset, data_length = get_data_chunk(filename)
+    size = data_length // (sample_width * channels)
+    half_blend_frames = get_half_blend_frames(frame_rate, blend_duration)
+    assert size > 2 * half_blend_frames > 0
+    channel_threshold = get_channel_threshold(threshold_level, sample_width, channels)
+    workers = workers or os.cpu_count() or 1
+    if shard_frames is None:
+        shard_frames = max(-(-size // (workers * 4)), BLOCK_FRAMES)
+    bounds = [ (start, min(start + shard_frames, size)) for start in range(0, size, shard_frames) ]
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            return detect_silences_parallel(filename, threshold_level, threshold_duration, blend_duration, workers, shard_frames, executor)
+    futures = [ executor.submit(_analyze_shard, filename, data_offset, sample_width, channels, size, start, end, half_blend_frames, channel_threshold) for start, end in bounds ]
+    runs = merge_runs(*( future.result() for future in futures ))
+    threshold_frames = int(threshold_duration * frame_rate)
+    return to_silence_regions(runs, size, half_blend_frames, threshold_frames, blend_duration)
@@ -1,18 +1,119 @@
+import concurrent.futures
+import functools
+import hashlib
+import json
 import openai
 import logging
 import os
+import random
+import time
 import tiktoken
 
+import analysis_cache
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+MODEL = 'gpt-3.5-turbo-16k'
+CHUNK_TOKENS = 6000
+MAX_IN_FLIGHT = 4
+RETRIES = 5
+BACKOFF = 1.0
+
 
-def calculate_tokens(text, model='gpt-3.5-turbo-16k'):
+@functools.lru_cache(maxsize=None)
+def get_encoder(model=MODEL):
     # To get the tokeniser corresponding to a specific model in the OpenAI API:
-    enc = tiktoken.encoding_for_model(model)
-    tokens = enc.encode(text)
-    return len(tokens)
+    return tiktoken.encoding_for_model(model)
+
+
+def calculate_tokens(text, model=MODEL):
+    return len(get_encoder(model).encode(text))
+
+
+@functools.lru_cache(maxsize=None)
+def get_api_key(filename='openai_api_key.txt'):
+    with open(filename, "r") as f:
+        return f.read().splitlines()[0]
+
+
+def openai_complete(messages, model=MODEL, api_base=None):
+    # The default client, other ones take the same messages and return the answer text.
+    answer = openai.ChatCompletion.create(model=model, messages=messages, api_key=get_api_key(), api_base=api_base)
+    logger.info('total_tokens: '+str(answer['usage']['total_tokens']))
+    return answer['choices'][0]['message']['content']
+
+
+def complete_cached(complete, messages, model=MODEL, retries=RETRIES, backoff=BACKOFF):
+    # Answers are cached by the hash of the request, failed requests are retried with exponential backoff.
+    key = 'summary-' + hashlib.sha256(json.dumps([ model, messages ], ensure_ascii=False).encode('utf-8')).hexdigest()
+    cached = analysis_cache.load(key)
+    if cached is not None:
+        return cached['content']
+    for attempt in range(retries):
+        try:
+            content = complete(messages)
+            break
+        except Exception as e:
+            if attempt == retries - 1:
+                raise
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.info('request failed: {!r}, retrying in {:.1f} s'.format(e, delay))
+            time.sleep(delay)
+    analysis_cache.store(key, { 'content': content })
+    return content
+
+
+def split_chunks(text, max_tokens=CHUNK_TOKENS, model=MODEL):
+    # Chunks of whole lines up to max_tokens, longer lines are split at token boundaries.
+    encoder = get_encoder(model)
+    chunks = []
+    lines = []
+    tokens = 0
+    for line in text.splitlines():
+        line_tokens = encoder.encode(line)
+        if len(line_tokens) > max_tokens:
+            pieces = [ encoder.decode(line_tokens[start:start+max_tokens]) for start in range(0, len(line_tokens), max_tokens) ]
+        else:
+            pieces = [ line ]
+        for piece in pieces:
+            piece_tokens = min(len(line_tokens), max_tokens) + 1
+            if lines and tokens + piece_tokens > max_tokens:
+                chunks.append('\n'.join(lines))
+                lines = []
+                tokens = 0
+            lines.append(piece)
+            tokens += piece_tokens
+    if lines:
+        chunks.append('\n'.join(lines))
+    return chunks
+
+
+def get_messages(text, instruction):
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": text + '\n\n' + instruction}
+    ]
+
+
+def summarize_transcript(text, instruction, complete=None, model=MODEL, max_tokens=CHUNK_TOKENS, max_in_flight=MAX_IN_FLIGHT):
+    # Map-reduce: chunks are summarized concurrently, the joined summaries are summarized again until they fit into one request.
+    if complete is None:
+        if not os.path.exists("openai_api_key.txt"):
+            logger.info("openai_api_key.txt not found")
+            return "Error: openai_api_key.txt not found"
+        complete = functools.partial(openai_complete, model=model)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        chunks = split_chunks(text, max_tokens, model)
+        while len(chunks) > 1:
+            logger.info('summarizing {} chunks'.format(len(chunks)))
+            summaries = list(executor.map(lambda chunk: complete_cached(complete, get_messages(chunk, instruction), model), chunks))
+            reduced = split_chunks('\n\n'.join(summaries), max_tokens, model)
+            if len(reduced) >= len(chunks):
+                raise ValueError('summaries of {} chunks do not get shorter'.format(len(chunks)))
+            chunks = reduced
+        return complete_cached(complete, get_messages(chunks[0] if chunks else '', instruction), model)
 
 
 def summarize(query):
@@ -21,18 +122,11 @@ def summarize(query):
         logger.info("openai_api_key.txt not found")
         return "Error: openai_api_key.txt not found"
 
-    with open("openai_api_key.txt", "r") as f:
-        openai.api_key = f.read().splitlines()[0]
     logger.info('forecast_tokens: '+str(calculate_tokens(query)))
-    answer = openai.ChatCompletion.create(
-        model='gpt-3.5-turbo-16k',
-        messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": str(query)}
-        ]    
-    )
-    logger.info('total_tokens: '+str(answer['usage']['total_tokens']))    
-    return answer['choices'][0]['message']['content']
+    return complete_cached(openai_complete, [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": str(query)}
+    ])
 
 
 def main():
@@ -0,0 +1,64 @@
+import io
+import os
+import threading
+import wave
+
+import numpy as np
+
+import audio_assembly
+import silence_detector
+
+
+FRAME_RATE = 48000
+DURATION = 60
+
+
+def make_wav(filename):
+    rng = np.random.default_rng(0)
+    values = rng.integers(-20000, 20000, (FRAME_RATE * DURATION, 2))
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(2)
+        wav.setsampwidth(2)
+        wav.setframerate(FRAME_RATE)
+        wav.writeframes(audio_assembly.encode_frames(values, 2))
+
+
+def read_pipe(fd, result):
+    with open(fd, 'rb') as f:
+        result.append(f.read())
+
+
+def test_write_wav_to_pipe(tmp_path):
+    filename = str(tmp_path / 'audio.wav')
+    make_wav(filename)
+    # One second regions, every third one is compressed, so the output is written in several blocks.
+    audio_regions = [ (second * FRAME_RATE, (second + 1) * FRAME_RATE, FRAME_RATE // 5 if second % 3 == 2 else FRAME_RATE) for second in range(DURATION) ]
+    read_fd, write_fd = os.pipe()
+    result = []
+    reader = threading.Thread(target=read_pipe, args=(read_fd, result))
+    reader.start()
+    with audio_assembly.MappedWave(filename) as wav:
+        with open(write_fd, 'wb') as f:
+            audio_assembly.write_wav(wav, audio_regions, f)
+        expected = b''.join( audio_assembly.compress_audio(wav, *region) for region in audio_regions )
+    reader.join()
+    assert len(expected) > 2 * audio_assembly.WRITE_SIZE
+
+    out_filename = str(tmp_path / 'out.wav')
+    with open(out_filename, 'wb') as f:
+        f.write(result[0])
+    assert silence_detector.get_data_chunk(out_filename) == (2, 2, FRAME_RATE, 44, len(expected))
+    with wave.open(out_filename) as wav:
+        assert wav.getnframes() == len(expected) // 4
+        assert wav.readframes(wav.getnframes()) == expected
+
+
+def test_write_wav_header_rf64():
+    # About 8 h of 48 kHz stereo does not fit into the 32 bit sizes of RIFF.
+    for nframes, riff in ((FRAME_RATE * DURATION, b'RIFF'), (FRAME_RATE * 8 * 3600, b'RF64')):
+        f = io.BytesIO()
+        audio_assembly.write_wav_header(f, 2, 2, FRAME_RATE, nframes)
+        assert f.getvalue()[:4] == riff
+        f.seek(0)
+        assert silence_detector.read_wav_header(f) == (2, 2, FRAME_RATE, nframes * 4)
+        assert f.tell() == len(f.getvalue())
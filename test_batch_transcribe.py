@@ -0,0 +1,96 @@
+import asyncio
+import json
+import struct
+import wave
+
+import websockets
+
+import batch_transcribe
+
+
+FRAME_RATE = 16000
+DURATION = 100
+SILENCES = [ (second - 0.5, second + 0.5) for second in range(10, 100, 10) ]
+
+
+def make_wav(filename):
+    # Every sample holds the second it is in, so the server knows where a shard starts.
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(FRAME_RATE)
+        for second in range(DURATION):
+            wav.writeframes(struct.pack('<h', second) * FRAME_RATE)
+
+
+class FakeServer:
+    # Answers every chunk with an empty partial result and the end of file with one phrase naming the second
+    # the shard starts at. Later shards answer sooner, so results arrive out of timeline order.
+
+    def __init__(self):
+        self.sessions = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def handle(self, websocket):
+        self.sessions += 1
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            config = json.loads(await websocket.recv())
+            assert config['config']['sample_rate'] == FRAME_RATE
+            second = None
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    if second is None:
+                        second = struct.unpack('<h', message[:2])[0]
+                    await websocket.send(json.dumps({ 'partial': '' }))
+                    continue
+                assert json.loads(message) == { 'eof': 1 }
+                await asyncio.sleep((DURATION - second) / 2000)
+                await websocket.send(json.dumps({ 'text': 'second {}'.format(second), 'result': [ { 'start': 0.0, 'end': 1.0, 'conf': 1.0, 'word': 'second' } ] }))
+        finally:
+            self.active -= 1
+
+
+def transcribe(tmp_path, sessions, min_shard_duration):
+    filename = str(tmp_path / 'audio.wav')
+    out_filepath = str(tmp_path / 'audio.txt')
+    make_wav(filename)
+    server = FakeServer()
+
+    async def main():
+        async with websockets.serve(server.handle, 'localhost', 0) as ws_server:
+            uri = 'ws://localhost:{}'.format(ws_server.sockets[0].getsockname()[1])
+            return await batch_transcribe.run_parallel(uri, filename, out_filepath, SILENCES, sessions, min_shard_duration)
+
+    phrases = asyncio.run(main())
+    with open(out_filepath) as f:
+        lines = f.read().splitlines()
+    return server, phrases, lines
+
+
+def test_shards_are_cut_at_silences():
+    assert batch_transcribe.get_shards(SILENCES, DURATION, 30) == [ (0, 30), (30, 60), (60, DURATION) ]
+    assert batch_transcribe.get_shards(SILENCES, DURATION, 10) == [ (second, second + 10) for second in range(0, DURATION, 10) ]
+    assert batch_transcribe.get_shards([], DURATION, 10) == [ (0, DURATION) ]
+
+
+def test_run_parallel_shards_and_sessions(tmp_path):
+    server, _, _ = transcribe(tmp_path, 3, 10)
+    assert server.sessions == 10
+    assert server.max_active == 3
+
+
+def test_run_parallel_phrase_order(tmp_path):
+    _, phrases, lines = transcribe(tmp_path, 4, 10)
+    starts = list(range(0, DURATION, 10))
+    assert [ (start, end) for start, end, _ in phrases ] == [ (start, start + 1.0) for start in starts ]
+    assert lines == [ 'second {}'.format(start) for start in starts ]
+
+
+def test_run_parallel_fewer_shards_than_sessions(tmp_path):
+    server, _, lines = transcribe(tmp_path, 8, 30)
+    assert server.sessions == 3
+    assert server.max_active <= 3
+    assert lines == [ 'second 0', 'second 30', 'second 60' ]
@@ -0,0 +1,129 @@
+import bisect
+import re
+
+
+DESCRIPTION_PATTERN = re.compile(r'(\d+):(\d\d):(\d\d)')
+CHAPTER_PATTERN = re.compile(r'^(\s*)(?:(\d+):)?(\d{1,2}):(\d\d)\b')
+SUBTITLE_PATTERN = re.compile(r'(?:(\d+):)?(\d{2}):(\d{2})([,.])(\d{3})')
+METADATA_PATTERN = re.compile(r'^(START|END)=(\d+)$')
+TIMEBASE_PATTERN = re.compile(r'^TIMEBASE=(\d+)/(\d+)$')
+
+
+class TimeMap:
+    # Maps times of the input to the result, built once from the regions of remove_silences. Times are
+    # mapped at frame precision: region i starts at input frame starts[i] and output frame offsets[i].
+
+    def __init__(self, regions, frame_rate, frames, transform_duration, closest_frames):
+        self.frame_rate = frame_rate
+        self.starts = []
+        self.ends = []
+        self.offsets = []
+        self.counts = []
+        offset = 0
+        for start, end, is_silence in regions:
+            start_frame = int(start * frame_rate)
+            end_frame = frames if end is None else int(end * frame_rate)
+            if end_frame <= start_frame:
+                continue
+            if is_silence:
+                count = closest_frames(transform_duration((end_frame - start_frame) / frame_rate), frame_rate)
+            else:
+                count = end_frame - start_frame
+            self.starts.append(start_frame)
+            self.ends.append(end_frame)
+            self.offsets.append(offset)
+            self.counts.append(count)
+            offset += count
+        self.frames = offset
+
+    def map_frame(self, frame):
+        # Output position of an input frame position, which may be fractional.
+        index = bisect.bisect_right(self.starts, frame) - 1
+        if index < 0:
+            return 0
+        start, end = self.starts[index], self.ends[index]
+        if frame >= end:
+            return self.offsets[index] + self.counts[index]
+        return self.offsets[index] + (frame - start) / (end - start) * self.counts[index]
+
+    def map(self, seconds):
+        return self.map_frame(seconds * self.frame_rate) / self.frame_rate
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def format_subtitle_time(seconds, separator, hours=True):
+    milliseconds = int(round(seconds * 1000))
+    text = '{:02d}:{:02d}{}{:03d}'.format((milliseconds // 60000) % 60, (milliseconds // 1000) % 60, separator, milliseconds % 1000)
+    if hours or milliseconds >= 3600000:
+        text = '{:02d}:{}'.format(milliseconds // 3600000, text)
+    return text
+
+
+def rewrite_description(time_map, description):
+    # H:MM:SS time codes anywhere in the text, in one pass.
+    def replace(match):
+        h, m, s = match.groups()
+        return format_time(time_map.map(int(h)*3600+int(m)*60+int(s)))
+    return DESCRIPTION_PATTERN.sub(replace, description)
+
+
+def rewrite_chapters(time_map, lines):
+    # Chapter lists with a H:MM:SS or M:SS time code at the start of every line.
+    for line in lines:
+        match = CHAPTER_PATTERN.match(line)
+        if match is None:
+            yield line
+            continue
+        indent, h, m, s = match.groups()
+        seconds = int(time_map.map(int(h or 0)*3600+int(m)*60+int(s)))
+        if h is None and seconds < 3600:
+            time_code = '{:d}:{:02d}'.format(seconds // 60, seconds % 60)
+        else:
+            time_code = format_time(seconds)
+        yield indent + time_code + line[match.end():]
+
+
+def rewrite_subtitles(time_map, lines):
+    # SRT and WebVTT cue timings, other lines are copied.
+    for line in lines:
+        if '-->' not in line:
+            yield line
+            continue
+        def replace(match):
+            h, m, s, separator, ms = match.groups()
+            seconds = int(h or 0)*3600 + int(m)*60 + int(s) + int(ms)/1000
+            return format_subtitle_time(time_map.map(seconds), separator, h is not None)
+        yield SUBTITLE_PATTERN.sub(replace, line)
+
+
+def rewrite_metadata(time_map, lines):
+    # START and END of [CHAPTER] sections of an FFMETADATA file, in units of their TIMEBASE.
+    numerator, denominator = 1, 1000
+    for line in lines:
+        match = TIMEBASE_PATTERN.match(line.strip())
+        if match is not None:
+            numerator, denominator = int(match.group(1)), int(match.group(2))
+        match = METADATA_PATTERN.match(line.strip())
+        if match is None:
+            yield line
+            continue
+        seconds = time_map.map(int(match.group(2)) * numerator / denominator)
+        yield '{}={}\n'.format(match.group(1), int(round(seconds * denominator / numerator)))
+
+
+def rewrite_file(time_map, filename, filename_out):
+    # Picks the format by the extension, the file is streamed line by line.
+    extension = filename.lower().rsplit('.', 1)[-1]
+    with open(filename, encoding='utf-8') as f, open(filename_out, 'w', encoding='utf-8') as f_out:
+        if extension in ('srt', 'vtt'):
+            f_out.writelines(rewrite_subtitles(time_map, f))
+        elif f.readline().startswith(';FFMETADATA'):
+            f.seek(0)
+            f_out.writelines(rewrite_metadata(time_map, f))
+        else:
+            f.seek(0)
+            f_out.writelines(rewrite_chapters(time_map, f))
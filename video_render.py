@@ -0,0 +1,391 @@
+import bisect
+import concurrent.futures
+import math
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+
+POOL_SIZE = 8
+
+# Bytes per frame of the raw pixel formats the pipe can carry, for a width and height.
+FRAME_SIZES = {
+    'yuv420p': lambda w, h: w * h + 2 * ((w + 1) // 2) * ((h + 1) // 2),
+    'yuvj420p': lambda w, h: w * h + 2 * ((w + 1) // 2) * ((h + 1) // 2),
+    'nv12': lambda w, h: w * h + 2 * ((w + 1) // 2) * ((h + 1) // 2),
+    'nv21': lambda w, h: w * h + 2 * ((w + 1) // 2) * ((h + 1) // 2),
+    'yuv422p': lambda w, h: w * h + 2 * ((w + 1) // 2) * h,
+    'yuvj422p': lambda w, h: w * h + 2 * ((w + 1) // 2) * h,
+    'yuv444p': lambda w, h: 3 * w * h,
+    'yuvj444p': lambda w, h: 3 * w * h,
+    'gray': lambda w, h: w * h,
+    'rgb24': lambda w, h: 3 * w * h,
+    'bgr24': lambda w, h: 3 * w * h,
+}
+
+# Encoder and bitstream filter for pieces that are joined with stream copied ones. The joined stream keeps
+# the parameter sets of the source, so pieces are only encoded for the source profiles, as ffprobe names them,
+# with the encoder profile and the pixel formats of each.
+SMART_CUT_CODECS = {
+    'h264': ('libx264', 'h264_mp4toannexb', {
+        'Constrained Baseline': ('baseline', ('yuv420p', 'yuvj420p')),
+        'Main': ('main', ('yuv420p', 'yuvj420p')),
+        'High': ('high', ('yuv420p', 'yuvj420p')),
+        'High 10': ('high10', ('yuv420p10le',)),
+        'High 4:2:2': ('high422', ('yuv422p', 'yuvj422p', 'yuv422p10le')),
+        'High 4:4:4 Predictive': ('high444', ('yuv444p', 'yuvj444p', 'yuv444p10le')),
+    }),
+    'hevc': ('libx265', 'hevc_mp4toannexb', {
+        'Main': ('main', ('yuv420p', 'yuvj420p')),
+        'Main 10': ('main10', ('yuv420p10le',)),
+    }),
+}
+
+
+def append_frames(ranges, start, end):
+    # Adds kept frames [start, end) to sorted ranges, merging adjacent ones.
+    if start >= end:
+        return ranges
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
+    return ranges
+
+
+def get_select_filter(ranges, frame_rate):
+    terms = [ 'eq(n,{})'.format(start) if end - start == 1 else 'between(n,{},{})'.format(start, end - 1) for start, end in ranges ]
+    return "select='\n{}',\nsetpts=N/({}*TB)\n".format('+\n'.join(terms or ['0']), frame_rate)
+
+
+def _write_audio(write_audio, fd, errors):
+    try:
+        with open(fd, 'wb') as f:
+            write_audio(f)
+    except BaseException as e:
+        errors.append(e)
+
+
+class AudioInput:
+    # The audio input of an encoder: a WAV filename, or write_audio(f) writing a WAV to a pipe the encoder reads
+    # through pass_fds, then the audio track is never written to disk.
+    __slots__ = ('audio', 'options', 'pass_fds', 'errors', '_write_fd', '_thread')
+
+    def __init__(self, audio):
+        self.audio = audio
+        self.errors = []
+        self._thread = None
+        if callable(audio):
+            read_fd, self._write_fd = os.pipe()
+            self.pass_fds = (read_fd,)
+            self.options = [ '-f', 'wav', '-i', 'pipe:{}'.format(read_fd) ]
+        else:
+            self._write_fd = None
+            self.pass_fds = ()
+            self.options = [ '-f', 'wav', '-i', audio ]
+
+    def start(self):
+        # Called once the encoder holds the read end.
+        if self._write_fd is None:
+            return
+        os.close(self.pass_fds[0])
+        self._thread = threading.Thread(target=_write_audio, args=(self.audio, self._write_fd, self.errors))
+        self._thread.start()
+
+    def close(self):
+        # The writer gets a broken pipe when the encoder is gone.
+        if self._thread is not None:
+            self._thread.join()
+        elif self._write_fd is not None:
+            os.close(self.pass_fds[0])
+            os.close(self._write_fd)
+
+    def check(self):
+        if self.errors:
+            raise self.errors[0]
+
+
+def run_encoder(inputs, audio, outputs):
+    # Runs ffmpeg with the input options, the AudioInput of audio and the output options.
+    audio_input = AudioInput(audio)
+    try:
+        command = [ 'ffmpeg' ] + inputs + audio_input.options + outputs
+        encoder = subprocess.Popen(command, pass_fds=audio_input.pass_fds)
+        audio_input.start()
+        if encoder.wait() != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, command)
+    finally:
+        audio_input.close()
+    audio_input.check()
+
+
+def render_filtergraph(path, ranges, frame_rate, audio, path_out):
+    # One ffmpeg process selects the kept frames, no raw frames go through python. audio is as with AudioInput.
+    script = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+    with script:
+        script.write(get_select_filter(ranges, frame_rate))
+    try:
+        run_encoder([ '-i', path ], audio, [ '-filter_script:v', script.name, '-map', '0:v:0', '-map', '1:a:0', '-r', str(frame_rate), '-pix_fmt', 'yuv420p', '-y', path_out ])
+    finally:
+        os.unlink(script.name)
+
+
+def get_pipe_format(pix_fmt):
+    # The source format avoids a conversion in the decoder, otherwise yuv420p avoids one in the encoder.
+    return pix_fmt if pix_fmt in FRAME_SIZES else 'yuv420p'
+
+
+def _read_frame(source, view):
+    filled = 0
+    while filled < len(view):
+        count = source.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+
+def pump_frames(source, sink, frame_size, ranges, frames_count, pool_size=POOL_SIZE):
+    # Reads frames_count frames into reusable buffers on one thread and writes the ones in ranges on another.
+    free = queue.Queue()
+    for _ in range(pool_size):
+        free.put(bytearray(frame_size))
+    filled = queue.Queue(maxsize=pool_size)
+    errors = []
+    counts = [0, 0]
+    stop = threading.Event()
+
+    def read():
+        try:
+            ranges_iterator = iter(ranges)
+            current = next(ranges_iterator, None)
+            for index in range(frames_count):
+                buffer = free.get()
+                if stop.is_set():
+                    break
+                if not _read_frame(source, memoryview(buffer)):
+                    break
+                counts[0] += 1
+                while current is not None and current[1] <= index:
+                    current = next(ranges_iterator, None)
+                if current is not None and current[0] <= index:
+                    filled.put(buffer)
+                else:
+                    free.put(buffer)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            filled.put(None)
+
+    def write():
+        try:
+            while True:
+                buffer = filled.get()
+                if buffer is None:
+                    return
+                sink.write(buffer)
+                counts[1] += 1
+                free.put(buffer)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            # Keep draining, so the reader is not blocked on a full queue or an empty pool.
+            while True:
+                buffer = filled.get()
+                if buffer is None:
+                    return
+                free.put(buffer)
+
+    time_start = time.time()
+    threads = [ threading.Thread(target=read), threading.Thread(target=write) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return counts[0], counts[1], time.time() - time_start
+
+
+def render_pipe(path, ranges, frames_count, frame_rate, width, height, pix_fmt, path_out, audio=None):
+    # Decodes frames into a pipe, writes the kept ones to the encoder and returns (frames read, frames written, seconds).
+    # audio is as with AudioInput, with a writer the encoder writes the final container in one pass.
+    pipe_format = get_pipe_format(pix_fmt)
+    command = [ 'ffmpeg', '-i', path, '-f', 'image2pipe', '-pix_fmt', pipe_format, '-vcodec', 'rawvideo', '-' ]
+    decoder = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+    command = [ 'ffmpeg', '-framerate', str(frame_rate), '-s', '{}x{}'.format(width, height), '-f', 'rawvideo', '-pix_fmt', pipe_format, '-i', '-' ]
+    audio_input = None
+    if audio is not None:
+        audio_input = AudioInput(audio)
+        command += audio_input.options + [ '-map', '0:v:0', '-map', '1:a:0' ]
+    command += [ '-pix_fmt', 'yuv420p', '-y', path_out ]
+    encoder = None
+    try:
+        encoder = subprocess.Popen(command, stdin=subprocess.PIPE, pass_fds=audio_input.pass_fds if audio_input else ())
+        if audio_input is not None:
+            audio_input.start()
+        stats = pump_frames(decoder.stdout, encoder.stdin, FRAME_SIZES[pipe_format](width, height), ranges, frames_count)
+        encoder.stdin.close()
+        encoder.wait()
+        if encoder.returncode != 0:
+            raise subprocess.CalledProcessError(encoder.returncode, command)
+    finally:
+        decoder.terminate()
+        decoder.wait()
+        if encoder is not None and encoder.poll() is None:
+            encoder.kill()
+            encoder.wait()
+        if audio_input is not None:
+            audio_input.close()
+    if audio_input is not None:
+        audio_input.check()
+    return stats
+
+
+def plan_smart_cut(ranges, keyframes):
+    # Splits kept frame ranges into ('copy', start, end) pieces of whole GOPs and ('encode', ranges) pieces around the cuts.
+    pieces = []
+    encode = []
+    for start, end in ranges:
+        first = bisect.bisect_left(keyframes, start)
+        last = bisect.bisect_right(keyframes, end) - 1
+        if first < len(keyframes) and last >= 0 and keyframes[first] < keyframes[last]:
+            append_frames(encode, start, keyframes[first])
+            if encode:
+                pieces.append(('encode', encode))
+                encode = []
+            pieces.append(('copy', keyframes[first], keyframes[last]))
+            append_frames(encode, keyframes[last], end)
+        else:
+            append_frames(encode, start, end)
+    if encode:
+        pieces.append(('encode', encode))
+    return pieces
+
+
+def get_smart_cut_options(info):
+    # Encoder options matching the profile, level and pixel format of a MediaInfo, and the bitstream filter,
+    # None when the pieces could not match the stream copied ones.
+    if info.codec_name not in SMART_CUT_CODECS:
+        return None
+    encoder, bitstream_filter, profiles = SMART_CUT_CODECS[info.codec_name]
+    if info.profile not in profiles or info.pix_fmt not in profiles[info.profile][1]:
+        return None
+    options = [ '-c:v', encoder, '-profile:v', profiles[info.profile][0], '-pix_fmt', info.pix_fmt ]
+    if info.level is not None and info.level > 0:
+        # ffprobe reports level_idc, ten times the H.264 level and thirty times the HEVC one.
+        if info.codec_name == 'h264':
+            options += [ '-level', '1b' if info.level == 9 else '{:g}'.format(info.level / 10) ]
+        else:
+            options += [ '-x265-params', 'level-idc={:g}'.format(info.level / 30) ]
+    return options, bitstream_filter
+
+
+def format_seek_time(seconds, round_up):
+    # -ss and -t have microsecond precision, seconds is rounded away from the neighbouring frames.
+    microseconds = max(math.ceil(seconds * 1000000) if round_up else math.floor(seconds * 1000000), 0)
+    return '{}.{:06d}'.format(microseconds // 1000000, microseconds % 1000000)
+
+
+def render_smart_cut(path, ranges, frame_rate, smart_cut_options, keyframes, audio, path_out):
+    # Stream copies whole GOPs inside kept ranges, re-encodes only around the cuts and joins pieces with the concat demuxer.
+    # smart_cut_options is the result of get_smart_cut_options, keyframes the result of ffprobe.get_keyframes,
+    # audio is as with AudioInput.
+    encoder_options, bitstream_filter = smart_cut_options
+    first_time, keyframe_times = keyframes
+    # Frame numbers are only used to plan the pieces, copies seek to the exact time of their keyframe.
+    times = {}
+    for time in keyframe_times:
+        times.setdefault(int(round((time - first_time) * frame_rate)), time)
+    pieces = plan_smart_cut(ranges, sorted(times))
+    directory = tempfile.mkdtemp()
+    try:
+        list_path = os.path.join(directory, 'pieces.ffconcat')
+        with open(list_path, 'w') as list_file:
+            list_file.write('ffconcat version 1.0\n')
+            for index, piece in enumerate(pieces):
+                piece_path = os.path.join(directory, '{:06d}.ts'.format(index))
+                if piece[0] == 'copy':
+                    # Seeking a copy lands on the last keyframe at or before -ss, so it is rounded up to the keyframe,
+                    # and the duration is rounded down to stop before the next copied one.
+                    _, start, end = piece
+                    command = [ 'ffmpeg', '-ss', format_seek_time(times[start], True), '-i', path, '-t', format_seek_time(times[end] - times[start], False) ]
+                    command += [ '-map', '0:v:0', '-c:v', 'copy', '-bsf:v', bitstream_filter, '-f', 'mpegts', '-y', piece_path ]
+                else:
+                    # Decoding drops the frames before -ss, half a frame earlier keeps the first one.
+                    piece_ranges = piece[1]
+                    offset = piece_ranges[0][0]
+                    script_path = os.path.join(directory, '{:06d}.txt'.format(index))
+                    with open(script_path, 'w') as script:
+                        script.write(get_select_filter([ (start - offset, end - offset) for start, end in piece_ranges ], frame_rate))
+                    command = [ 'ffmpeg', '-ss', format_seek_time(first_time + (offset - 0.5) / frame_rate, False), '-t', str((piece_ranges[-1][1] - offset) / frame_rate), '-i', path ]
+                    command += [ '-filter_script:v', script_path ]
+                    command += [ '-map', '0:v:0', '-r', str(frame_rate) ] + encoder_options + [ '-bsf:v', bitstream_filter, '-f', 'mpegts', '-y', piece_path ]
+                subprocess.run(command, stderr=subprocess.DEVNULL).check_returncode()
+                list_file.write("file '{}'\n".format(piece_path))
+        run_encoder([ '-f', 'concat', '-safe', '0', '-i', list_path ], audio, [ '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-y', path_out ])
+    finally:
+        shutil.rmtree(directory)
+    return sum( 1 for piece in pieces if piece[0] == 'copy' ), sum( 1 for piece in pieces if piece[0] == 'encode' )
+
+
+def split_chunks(cut_frames, frames_count, chunks):
+    # Picks chunks-1 of the cut frames (silence starts) closest to an even split, returns chunk bounds.
+    bounds = [0]
+    for index in range(1, chunks):
+        target = frames_count * index // chunks
+        position = bisect.bisect_left(cut_frames, target)
+        candidates = [ cut for cut in cut_frames[max(position-1, 0):position+1] if cut > bounds[-1] ]
+        if candidates:
+            bounds.append(min(candidates, key=lambda cut: abs(cut - target)))
+    bounds.append(frames_count)
+    return [ (start, end) for start, end in zip(bounds[:-1], bounds[1:]) if start < end ]
+
+
+def clip_ranges(ranges, start, end):
+    return [ (max(range_start, start), min(range_end, end)) for range_start, range_end in ranges if range_start < end and range_end > start ]
+
+
+def render_chunk(path, ranges, frame_rate, start, end, chunk_path, first_time=0):
+    # first_time is the result of ffprobe.get_start_offset. Decoding drops the frames before -ss, half a frame earlier
+    # keeps the first one, so the frame numbers of the filter are the ones of the plan.
+    script_path = chunk_path + '.txt'
+    with open(script_path, 'w') as script:
+        script.write(get_select_filter([ (range_start - start, range_end - start) for range_start, range_end in ranges ], frame_rate))
+    try:
+        command = [ 'ffmpeg', '-ss', format_seek_time(first_time + (start - 0.5) / frame_rate, False), '-t', str((end - start) / frame_rate), '-i', path, '-filter_script:v', script_path ]
+        command += [ '-map', '0:v:0', '-r', str(frame_rate), '-pix_fmt', 'yuv420p', '-f', 'mp4', '-y', chunk_path ]
+        subprocess.run(command, stderr=subprocess.DEVNULL).check_returncode()
+    finally:
+        os.unlink(script_path)
+
+
+def render_parallel(path, ranges, frame_rate, frames_count, cut_frames, audio, path_out, workers=None, executor=None, first_time=0):
+    # Encodes time chunks cut at silences on separate ffmpeg processes and joins them without re-encoding.
+    # The audio track is compressed as a whole, so the drift accounting is the one of a serial run. audio is as
+    # with AudioInput, it is read when the chunks are joined.
+    workers = workers or os.cpu_count() or 1
+    if executor is None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return render_parallel(path, ranges, frame_rate, frames_count, cut_frames, audio, path_out, workers, executor, first_time)
+    chunks = [ (start, end, clip_ranges(ranges, start, end)) for start, end in split_chunks(cut_frames, frames_count, workers) ]
+    chunks = [ chunk for chunk in chunks if chunk[2] ]
+    directory = tempfile.mkdtemp()
+    try:
+        chunk_paths = [ os.path.join(directory, '{:06d}.mp4'.format(index)) for index in range(len(chunks)) ]
+        futures = [ executor.submit(render_chunk, path, chunk_ranges, frame_rate, start, end, chunk_path, first_time) for (start, end, chunk_ranges), chunk_path in zip(chunks, chunk_paths) ]
+        for future in futures:
+            future.result()
+        list_path = os.path.join(directory, 'chunks.ffconcat')
+        with open(list_path, 'w') as list_file:
+            list_file.write('ffconcat version 1.0\n')
+            for chunk_path in chunk_paths:
+                list_file.write("file '{}'\n".format(chunk_path))
+        run_encoder([ '-f', 'concat', '-safe', '0', '-i', list_path ], audio, [ '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', '-y', path_out ])
+    finally:
+        shutil.rmtree(directory)
+    return len(chunks)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import json
+import os
+import socket
+import sqlite3
+import time
+import traceback
+
+from batch_silence_remover import Config, run
+
+
+POLL_INTERVAL = 1.0
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+
+class DirectoryQueue:
+    # Jobs are JSON files in directory, claimed by renaming them into running/, so several workers can share
+    # the directory. Finished jobs go to done/ or failed/ with their result or error.
+
+    def __init__(self, directory):
+        self.directory = directory
+        for state in ('running', 'done', 'failed'):
+            os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+    def put(self, job):
+        job_id = '{:017.6f}-{}.json'.format(time.time(), os.getpid())
+        tmp_name = os.path.join(self.directory, '.' + job_id)
+        with open(tmp_name, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+        os.replace(tmp_name, os.path.join(self.directory, job_id))
+        return job_id
+
+    def claim(self):
+        for job_id in sorted(os.listdir(self.directory)):
+            if job_id.startswith('.') or not job_id.endswith('.json'):
+                continue
+            running_name = os.path.join(self.directory, 'running', job_id)
+            try:
+                os.rename(os.path.join(self.directory, job_id), running_name)
+            except FileNotFoundError:
+                # Claimed by another worker.
+                continue
+            with open(running_name, encoding='utf-8') as f:
+                return job_id, json.load(f)
+        return None
+
+    def finish(self, job_id, job, result=None, error=None):
+        with open(os.path.join(self.directory, 'failed' if error else 'done', job_id), 'w', encoding='utf-8') as f:
+            json.dump(dict(job, result=result, error=error), f, indent=1)
+        os.unlink(os.path.join(self.directory, 'running', job_id))
+
+
+class SqliteQueue:
+    # One row per job, BEGIN IMMEDIATE makes claiming atomic between workers.
+
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename, timeout=60, isolation_level=None)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY,
+            job TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'queued',
+            worker TEXT,
+            result TEXT,
+            error TEXT,
+            updated REAL)''')
+
+    def put(self, job):
+        return self.connection.execute('INSERT INTO jobs (job, updated) VALUES (?, ?)', (json.dumps(job), time.time())).lastrowid
+
+    def claim(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.connection.execute("SELECT id, job FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+                self.connection.execute("UPDATE jobs SET state = 'running', worker = ?, updated = ? WHERE id = ?", (worker, time.time(), row[0]))
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def finish(self, job_id, job, result=None, error=None):
+        self.connection.execute('UPDATE jobs SET state = ?, result = ?, error = ?, updated = ? WHERE id = ?',
+            ('failed' if error else 'done', json.dumps(result), error, time.time(), job_id))
+
+
+def open_queue(name):
+    if name.lower().endswith(SQLITE_EXTENSIONS):
+        return SqliteQueue(name)
+    return DirectoryQueue(name)
+
+
+def work(queue, workers=0, render_workers=1, once=False, poll_interval=POLL_INTERVAL):
+    # Runs jobs { "path", "path_out", "options" } one by one in this process: the pools, the memoized probes
+    # and the imported modules stay warm between them. workers and render_workers are the pool sizes and the
+    # defaults of the job options. With once, returns when the queue is empty.
+    defaults = { 'workers': workers, 'render_workers': render_workers }
+    find_executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers or None) if workers != 1 else None
+    render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=render_workers or os.cpu_count() or 1) if render_workers != 1 else None
+    count = 0
+    try:
+        while True:
+            claimed = queue.claim()
+            if claimed is None:
+                if once:
+                    return count
+                time.sleep(poll_interval)
+                continue
+            job_id, job = claimed
+            print('# Job {}: {}'.format(job_id, job['path']))
+            try:
+                result = run(job['path'], job['path_out'], Config(**dict(defaults, **job.get('options', {}))), find_executor=find_executor, render_executor=render_executor)
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+                queue.finish(job_id, job, error=error)
+            else:
+                queue.finish(job_id, job, { 'rendered': result.rendered, 'gaps': len(result.silences), 'metrics': result.metrics })
+            count += 1
+    finally:
+        if find_executor is not None:
+            find_executor.shutdown()
+        if render_executor is not None:
+            render_executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('queue', type=str, help='directory of job files or an SQLite database (.db, .sqlite)')
+    parser.add_argument('--submit', type=str, nargs=2, metavar=('PATH', 'PATH_OUT'), help='add a job to the queue and exit')
+    parser.add_argument('--options', type=json.loads, default={}, help='JSON object of options of the submitted job, like {"linear": 0.2}')
+    parser.add_argument('--workers', type=int, default=0, help='number of processes for finding gaps, 0 for all cores')
+    parser.add_argument('--render-workers', type=int, default=1, help='number of ffmpeg processes encoding chunks, 0 for all cores')
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty instead of waiting for jobs')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='seconds between checks of an empty queue')
+    args = parser.parse_args()
+
+    queue = open_queue(args.queue)
+    if args.submit:
+        # Unknown options fail here rather than in the worker.
+        Config(**args.options)
+        print(queue.put({ 'path': args.submit[0], 'path_out': args.submit[1], 'options': args.options }))
+        return
+    count = work(queue, args.workers, args.render_workers, args.once, args.poll_interval)
+    print('# Done {} jobs'.format(count))
+
+
+if __name__ == "__main__":
+    main()